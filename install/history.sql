@@ -0,0 +1,20 @@
+-- this upgrades an existing stock database with the newest historical value
+-- of each stock property value, and the history index of the backtest (new
+-- databases get them from syncdb).
+--
+-- run it with: mysql -u stock -p stock < history.sql
+
+alter table search_stockpropertyvalue
+  add column history_value decimal(19,5) null;
+
+-- the newest historical value, the importers keep it up to date
+update search_stockpropertyvalue v
+   set v.history_value = (select h.historical_value
+                            from search_stockpropertyvaluehistory h
+                           where h.current_value_id = v.id
+                           order by h.historical_date desc, h.id desc
+                           limit 1);
+
+-- the backtest reads the history of all the values in a range of dates
+create index search_stockpropertyvaluehistory_day
+    on search_stockpropertyvaluehistory (historical_date);
@@ -0,0 +1,32 @@
+-- this upgrades an existing stock database with the indexes for the search
+-- and the import (new databases get them from syncdb).
+--
+-- run it with: mysql -u stock -p stock < indexes.sql
+
+-- move the history of duplicated values to the newest value (highest id)
+update search_stockpropertyvaluehistory h
+       join search_stockpropertyvalue v1 on v1.id = h.current_value_id
+       join search_stockpropertyvalue v2 on v2.symbol_id = v1.symbol_id
+                                        and v2.stock_property_id = v1.stock_property_id
+                                        and v2.id > v1.id
+   set h.current_value_id = (select max(v3.id) from search_stockpropertyvalue v3
+                              where v3.symbol_id = v1.symbol_id
+                                and v3.stock_property_id = v1.stock_property_id);
+
+-- remove the duplicated values, keep the newest
+delete v1 from search_stockpropertyvalue v1
+       join search_stockpropertyvalue v2 on v2.symbol_id = v1.symbol_id
+                                        and v2.stock_property_id = v1.stock_property_id
+                                        and v2.id > v1.id;
+
+-- one value per company and stock property, also used by the import
+alter table search_stockpropertyvalue
+  add unique index search_stockpropertyvalue_symbol_property (symbol_id, stock_property_id);
+
+-- the search filters on stock property and value range, and joins on company
+create index search_stockpropertyvalue_search
+    on search_stockpropertyvalue (stock_property_id, value, symbol_id);
+
+-- the import finds the newest historical value
+create index search_stockpropertyvaluehistory_date
+    on search_stockpropertyvaluehistory (current_value_id, historical_date);
@@ -0,0 +1,116 @@
+import os, sys, time
+
+"""
+The common module sets up Django for the benchmark scripts, and has helpers
+to time queries and show their query plans.
+
+The benchmarks are run from the stockscreener directory, eg:
+
+  python benchmarks/indexes.py
+
+They use the project settings, unless DJANGO_SETTINGS_MODULE is set.
+"""
+
+PROJECT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(PROJECT_PATH))
+sys.path.insert(0, PROJECT_PATH)
+
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    from django.core.management import setup_environ
+    import settings as project_settings
+    setup_environ(project_settings)
+
+from django.conf import settings
+
+from django.db import connection, transaction
+
+def execute(sql, params=()):
+    """
+    Execute one SQL statement, and commit it.
+    """
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+    return cursor
+
+def insert_many(sql, rows, batch_size=5000):
+    """
+    Insert the rows with executemany, in batches of batch_size rows.
+    """
+    cursor = connection.cursor()
+    for i in range(0, len(rows), batch_size):
+        cursor.executemany(sql, rows[i:i+batch_size])
+    transaction.commit_unless_managed()
+
+def timed(func, repeat=5):
+    """
+    Run func repeat times, and return the best time in milliseconds and the
+    result of the last run.
+    """
+    best, result = None, None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        used = (time.time() - start) * 1000.0
+        if best is None or used < best:
+            best = used
+    return best, result
+
+def explain(sql, params=()):
+    """
+    Return the query plan of the SQL as a list of lines.
+    """
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        prefix = 'explain query plan '
+    else:
+        prefix = 'explain '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [ ' | '.join([ str(c) for c in row ]) for row in cursor.fetchall() ]
+
+def create_test_database():
+    """
+    Create the test database (like the tests do), so the benchmark does not
+    touch the real data. Returns the name of the real database.
+    """
+    old_name = settings.DATABASE_NAME
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    return old_name
+
+def destroy_test_database(old_name):
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+def fill_synthetic(companies, properties, seed=42):
+    """
+    Fill the database with companies * properties stock property values. Each
+    property has its own scale of values, and some values are missing.
+    """
+    import random
+    from decimal import Decimal
+    random.seed(seed)
+
+    sectors = [ (id, 'Sector %d' % id) for id in range(1, 11) ]
+    insert_many("insert into search_sector (id, name) values (%s, %s)", sectors)
+
+    exchanges = ('CSE', 'STO', 'HEL', 'ISE')
+    rows = []
+    for id in range(1, companies + 1):
+        rows.append((id, 'Company %d' % id, 'C%d' % id, 'DKK', exchanges[id % 4], 'M',
+                     random.randint(1, 10), 'DK%d' % id, 'C%d.CO' % id))
+    insert_many("""insert into search_company (id, name, symbol, currency, exchange, size,
+                   sector_id, isin, reuters_symbol_guess) values (%s, %s, %s, %s, %s, %s, %s, %s, %s)""", rows)
+
+    rows = [ (id, 'Property %d' % id, 'http://localhost/SYMBOL', '//td', 'x') for id in range(1, properties + 1) ]
+    insert_many("""insert into search_stockproperty (id, name, url, xml_path, convert_expression)
+                   values (%s, %s, %s, %s, %s)""", rows)
+
+    rows = []
+    for symbol_id in range(1, companies + 1):
+        for stock_property_id in range(1, properties + 1):
+            if random.random() < 0.05:
+                continue
+            value = random.uniform(0, 10 ** (stock_property_id % 6))
+            rows.append((len(rows) + 1, symbol_id, stock_property_id, Decimal('%.2f' % value)))
+    insert_many("""insert into search_stockpropertyvalue (id, symbol_id, stock_property_id, value)
+                   values (%s, %s, %s, %s)""", rows)
+    return len(rows)
@@ -0,0 +1,93 @@
+import random
+from decimal import Decimal
+from common import execute, insert_many, timed, explain
+
+"""
+Benchmark of the indexes on search_stockpropertyvalue (see search/sql/ and
+install/indexes.sql).
+
+It creates two scratch tables like search_stockpropertyvalue with 100k rows,
+one with only the foreign key indexes (as before) and one with the unique
+(symbol_id, stock_property_id) index and the search index, and shows the
+query plan and the time of the search and the import lookup on both.
+The scratch tables are dropped again at the end.
+"""
+
+COMPANIES = 2500
+PROPERTIES = 40
+
+TABLE = """
+create table %s (
+    id integer not null primary key,
+    symbol_id integer not null,
+    stock_property_id integer not null,
+    value decimal(19, 5) not null
+)
+"""
+
+PLAIN_INDEXES = (
+    "create index %(t)s_symbol on %(t)s (symbol_id)",
+    "create index %(t)s_property on %(t)s (stock_property_id)",
+)
+
+SEARCH_INDEXES = (
+    "create unique index %(t)s_symbol_property on %(t)s (symbol_id, stock_property_id)",
+    "create index %(t)s_search on %(t)s (stock_property_id, value, symbol_id)",
+)
+
+# the criteria part of SEARCH_QUERY, two criterias
+SEARCH = """
+select v.symbol_id, count(*) as number
+  from %s v
+ where ( v.stock_property_id = %%s and v.value between %%s and %%s )
+    or ( v.stock_property_id = %%s and v.value between %%s and %%s )
+ group by v.symbol_id
+having count(*) >= 2
+"""
+
+# the lookup done by Extractor.extract
+LOOKUP = "select id, value from %s where stock_property_id = %%s and symbol_id = %%s"
+
+def create(table, indexes, rows):
+    execute(TABLE % table)
+    for index in indexes:
+        execute(index % {'t': table})
+    insert_many("insert into %s (id, symbol_id, stock_property_id, value) values (%%s, %%s, %%s, %%s)" % table, rows)
+
+def run(table):
+    print "==", table
+    search_params = (3, Decimal('10'), Decimal('20'), 7, Decimal('0'), Decimal('50'))
+    for line in explain(SEARCH % table, search_params):
+        print "  search plan:", line
+    used, rows = timed(lambda: execute(SEARCH % table, search_params).fetchall())
+    print "  search: %.2f ms (%d rows)" % (used, len(rows))
+
+    lookup_params = (3, COMPANIES / 2)
+    for line in explain(LOOKUP % table, lookup_params):
+        print "  lookup plan:", line
+    used, rows = timed(lambda: execute(LOOKUP % table, lookup_params).fetchall(), repeat=50)
+    print "  lookup: %.3f ms" % used
+
+def main():
+    random.seed(42)
+    rows = []
+    for symbol_id in range(1, COMPANIES + 1):
+        for stock_property_id in range(1, PROPERTIES + 1):
+            rows.append((len(rows) + 1, symbol_id, stock_property_id,
+                         Decimal(str(round(random.uniform(0, 100), 2)))))
+
+    tables = (('bench_value_plain', PLAIN_INDEXES), ('bench_value_indexed', SEARCH_INDEXES))
+    try:
+        for table, indexes in tables:
+            create(table, indexes, rows)
+        for table, indexes in tables:
+            run(table)
+    finally:
+        for table, indexes in tables:
+            try:
+                execute("drop table %s" % table)
+            except Exception:
+                pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import sys
+from decimal import Decimal
+from common import timed, create_test_database, destroy_test_database, fill_synthetic
+
+"""
+Benchmark of the search strategies in search.query ('union', 'intersect' and
+'memory') on synthetic data in the test database.
+
+  python benchmarks/strategies.py [companies] [properties]
+"""
+
+def searches():
+    """
+    The searches to time: (description, criterias)
+    """
+    from stockscreener.search.search import MinMaxCriteria as C
+    return (
+        ('one wide criteria', [C(1, Decimal('1'), None)]),
+        ('one narrow criteria', [C(1, Decimal('5.0'), Decimal('5.1'))]),
+        ('wide + narrow', [C(1, Decimal('1'), None), C(2, Decimal('50'), Decimal('50.5'))]),
+        ('four medium', [C(1, Decimal('2'), Decimal('8')), C(2, Decimal('20'), Decimal('80')),
+                         C(3, Decimal('200'), Decimal('800')), C(4, Decimal('2000'), Decimal('8000'))]),
+        ('no match', [C(1, Decimal('1'), None), C(2, Decimal('1000'), None)]),
+    )
+
+def main(companies=5000, properties=40):
+    old_name = create_test_database()
+    try:
+        from stockscreener.search import search, snapshot
+        print "values:", fill_synthetic(companies, properties)
+        snapshot.get_snapshot()
+
+        for name, criterias in searches():
+            line = []
+            for strategy in search.STRATEGIES:
+                used, found = timed(lambda: search.find_ids(criterias, strategy=strategy))
+                line.append("%s %8.2f ms (%d)" % (strategy, used, len(found)))
+            print "%-20s %s" % (name, '   '.join(line))
+    finally:
+        destroy_test_database(old_name)
+
+if __name__ == '__main__':
+    main(*[ int(a) for a in sys.argv[1:] ])
@@ -15,14 +15,30 @@ class GraphHelper:
     # x_size is how many datapoints on the x axis of the graph
     # y_size is how many datapoints on the y axis of the graph
     #
+    # the values are loaded from the database once, and counted in the ranges
+    # in one pass. A range includes its start but not its end (except the last
+    # range, which ends with the maximum), so each value is counted once.
+    #
     def create_data(self, x_size, y_size, stock_property_id):
 
-        # find minimum and maximum values in the database
-        values = StockPropertyValue.objects.filter(stock_property__id=stock_property_id).values_list('value',flat=True)
+        # load the values from the database (one query)
+        values = list(StockPropertyValue.objects.filter(stock_property__id=stock_property_id).values_list('value',flat=True))
 
         a = min(values)
         b = max(values)
 
+        # count the values in each range
+        counts = count_values(values, a, b, x_size)
+
+        return self.create_grouped_values(counts, a, b)
+
+    #
+    # method to create the data for graph from the number of values in each range
+    #
+    def create_grouped_values(self, counts, a, b):
+
+        x_size = len(counts)
+
         # calculate how big is each x
         diff = (b - a) / x_size
 
@@ -40,10 +56,8 @@ class GraphHelper:
             # calculate end range for this grouped value
             current_end_range = current_start_range + diff
 
-            # ask database count of companies in database with value inside this range
-            number_of_companies = StockPropertyValue.objects.filter(stock_property__id = stock_property_id,
-                                                                    value__gte = current_start_range,
-                                                                    value__lte = current_end_range).count()
+            # number of companies with value inside this range
+            number_of_companies = counts[i]
 
             # update the min/max for Y range
             if y_min is None or number_of_companies < y_min:
@@ -87,8 +101,90 @@ class GraphHelper:
 
         return 'http://chart.apis.google.com/chart?%s' % '&'.join(url_params)
 
+    #
+    # method to draw the graph as an SVG image, without asking Google Chart.
+    #
+    # it looks like the graph from create_graph_url: a line with a gradient fill
+    # below it, the x range under the graph and the y range to the left.
+    #
+    def create_graph_svg(self, data, y_min, y_max, x_size, y_size):
+
+        x_min = min([ d.start_range for d in data ])
+        x_max = max([ d.end_range for d in data ])
+
+        # the area of the line (room for the labels to the left and below)
+        left, top, right, bottom = 30, 4, x_size - 4, y_size - 14
+        width, height = right - left, bottom - top
+
+        # the point of each grouped value
+        points = []
+        for i, d in enumerate(data):
+            if len(data) == 1:
+                x = left + width / 2.0
+            else:
+                x = left + width * i / float(len(data) - 1)
+            if y_max == y_min:
+                y = bottom
+            else:
+                y = bottom - height * (d.number_of_companies - y_min) / float(y_max - y_min)
+            points.append('%.1f,%.1f' % (x, y))
+
+        line = ' '.join(points)
+        area = '%d,%d %s %d,%d' % (left, bottom, line, right, bottom)
+
+        return SVG_GRAPH % {
+            'width': x_size, 'height': y_size,
+            'left': left, 'top': top, 'right': right, 'bottom': bottom,
+            'plot_width': width, 'plot_height': height,
+            'line': line, 'area': area,
+            'label_y': y_size - 3, 'label_x': left - 3,
+            'x_min': x_min.normalize(), 'x_max': x_max.normalize(),
+            'y_min': y_min, 'y_max': y_max,
+        }
+
+# the SVG image of create_graph_svg, with the colors of create_graph_url
+SVG_GRAPH = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" width="%(width)d" height="%(height)d" viewBox="0 0 %(width)d %(height)d">
+  <defs>
+    <linearGradient id="fill" x1="0" y1="0" x2="0" y2="1">
+      <stop offset="0" stop-color="#76A4FB"/>
+      <stop offset="1" stop-color="#ffffff"/>
+    </linearGradient>
+  </defs>
+  <rect width="%(width)d" height="%(height)d" fill="#EFEFEF"/>
+  <rect x="%(left)d" y="%(top)d" width="%(plot_width)d" height="%(plot_height)d" fill="#ffffff"/>
+  <polygon points="%(area)s" fill="url(#fill)"/>
+  <polyline points="%(line)s" fill="none" stroke="#4D89F9" stroke-width="2"/>
+  <g font-family="sans-serif" font-size="9" fill="#444444">
+    <text x="%(left)d" y="%(label_y)d">%(x_min)s</text>
+    <text x="%(right)d" y="%(label_y)d" text-anchor="end">%(x_max)s</text>
+    <text x="%(label_x)d" y="%(bottom)d" text-anchor="end">%(y_min)s</text>
+    <text x="%(label_x)d" y="%(top)d" text-anchor="end" dominant-baseline="hanging">%(y_max)s</text>
+  </g>
+</svg>
+"""
+
 # http://chart.apis.google.com/chart?chxt=x,y&chds=0,10&chd=t:10,5,0,4,10&chf=c,lg,90,76A4FB,0.5,ffffff,0|bg,s,EFEFEF&chs=300x100&cht=lc&chxl=0:0|5
 
+#
+# find the range of a value (0 to x_size-1) from its distance to the minimum "a",
+# diff is how big is each range. The maximum is in the last range.
+#
+def range_index(value, a, diff, x_size):
+    if diff == 0:
+        return 0
+    return max(0, min(int((value - a) / diff), x_size - 1))
+
+#
+# count the values in each of the x_size ranges between a and b
+#
+def count_values(values, a, b, x_size):
+    diff = (b - a) / x_size
+    counts = [0] * x_size
+    for value in values:
+        counts[range_index(value, a, diff, x_size)] += 1
+    return counts
+
 # class to hold grouped values for use by the graph creation.
 class GroupedValue:
 
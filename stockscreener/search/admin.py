@@ -1,4 +1,4 @@
-from models import StockProperty, StockPropertyValue, StockPropertyValueHistory, Company, Sector
+from models import StockProperty, StockPropertyValue, StockPropertyValueHistory, Company, Sector, SavedScreen
 from django.contrib import admin
 
 """
@@ -23,9 +23,13 @@ class StockPropertyValueAdmin(admin.ModelAdmin):
 class StockPropertyValueHistoryAdmin(admin.ModelAdmin):
     list_display = ['current_value', 'historical_value', 'historical_date']
 
+class SavedScreenAdmin(admin.ModelAdmin):
+    list_display = ['name', 'criterias', 'sector', 'exchange']
+
 # register models and modeladmins with the admin site.
 admin.site.register(StockProperty, StockPropertyAdmin)
 admin.site.register(StockPropertyValue, StockPropertyValueAdmin)
 admin.site.register(StockPropertyValueHistory, StockPropertyValueHistoryAdmin)
 admin.site.register(Company, CompanyAdmin)
 admin.site.register(Sector, SectorAdmin)
+admin.site.register(SavedScreen, SavedScreenAdmin)
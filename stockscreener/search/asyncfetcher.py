@@ -0,0 +1,343 @@
+import asyncore, socket, time, urlparse
+from collections import deque
+
+"""
+The asyncfetcher module downloads many pages at the same time in one thread,
+with non-blocking sockets (asyncore), as an alternative to the worker threads
+of the fetcher module (see importall --engine).
+
+A few HTTP/1.1 keep-alive connections are opened per host, and each connection
+downloads the pages of its host one after another, so the connection is reused
+instead of connecting for every page. With many hosts there are many requests
+in flight, without a thread per request.
+
+If a proxy is given (see extractor.get_proxy), the connections go to the proxy, and the
+requests have the full URL, like urllib2 does for a http proxy. Only http URLs
+are supported.
+"""
+
+# the number of redirects followed for one page
+MAX_REDIRECTS = 5
+
+class HttpError(Exception):
+    """
+    HTTP error is the error of a page that could not be downloaded.
+    """
+    pass
+
+class HttpConnection(asyncore.dispatcher):
+    """
+    Http connection is one keep-alive connection to a host (or the proxy). It
+    sends one request at a time, and reads the response (with Content-Length,
+    chunked, or until the connection is closed).
+    """
+
+    def __init__(self, fetcher, host, address, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.fetcher = fetcher
+        self.host = host
+        self.page = None
+        self.requests = 0
+        self.outgoing = ''
+        self.incoming = ''
+        self.last_active = time.time()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def send_request(self, page, path):
+        """
+        Send the request of the page, page is [url, current url, redirects].
+        """
+        self.page = page
+        self.requests += 1
+        self.state = 'status'
+        self.status = None
+        self.headers = {}
+        self.body = []
+        self.length = None
+        self.outgoing = ('GET %s HTTP/1.1\r\n'
+                         'Host: %s\r\n'
+                         'Connection: keep-alive\r\n'
+                         'Accept-Encoding: identity\r\n'
+                         'User-Agent: stockscreener\r\n\r\n') % (path, self.host)
+        self.last_active = time.time()
+
+    def writable(self):
+        return not self.connected or len(self.outgoing) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+        self.last_active = time.time()
+
+    def handle_read(self):
+        data = self.recv(65536)
+        self.last_active = time.time()
+        if data:
+            self.incoming += data
+            self.parse()
+
+    def handle_close(self):
+        if self.page is not None and self.state == 'body' and self.length is None:
+            # the body is read until the connection is closed
+            self.body.append(self.incoming)
+            self.incoming = ''
+            self.done(keep_alive=False)
+        elif self.page is not None and self.requests > 1 and self.status is None and self.incoming == '':
+            # the host closed the kept-alive connection before the request
+            # got there, try again with another connection
+            page = self.page
+            self.page = None
+            self.fetcher.retry(page)
+        elif self.page is not None:
+            self.failed(HttpError('Connection closed'))
+        self.close()
+        self.fetcher.connection_closed(self)
+
+    def handle_error(self):
+        import sys
+        error = sys.exc_info()[1]
+        self.close()
+        if self.page is not None:
+            self.failed(error)
+        self.fetcher.connection_closed(self)
+
+    def parse(self):
+        """
+        Parse as much of the response as there is in incoming.
+        """
+        while self.page is not None:
+            if self.state in ('status', 'headers', 'trailer'):
+                end = self.incoming.find('\r\n')
+                if end < 0:
+                    return
+                line = self.incoming[:end]
+                self.incoming = self.incoming[end + 2:]
+                if self.state == 'status':
+                    self.version, self.status = line.split(' ', 2)[:2]
+                    self.state = 'headers'
+                elif self.state == 'trailer':
+                    if line == '':
+                        self.done()
+                elif line != '':
+                    name, value = line.split(':', 1)
+                    self.headers[name.strip().lower()] = value.strip()
+                elif self.status.startswith('1'):
+                    # 100 continue, the real response follows
+                    self.state = 'status'
+                    self.headers = {}
+                else:
+                    self.start_body()
+            elif self.state == 'body':
+                if self.length is None:
+                    # read until the connection is closed
+                    return
+                if len(self.incoming) < self.length:
+                    return
+                self.body.append(self.incoming[:self.length])
+                self.incoming = self.incoming[self.length:]
+                if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+                    self.state = 'chunk-end'
+                else:
+                    self.done()
+            elif self.state == 'chunk-end':
+                # the \r\n after a chunk
+                if len(self.incoming) < 2:
+                    return
+                self.incoming = self.incoming[2:]
+                self.state = 'chunk'
+            elif self.state == 'chunk':
+                end = self.incoming.find('\r\n')
+                if end < 0:
+                    return
+                self.length = int(self.incoming[:end].split(';')[0], 16)
+                self.incoming = self.incoming[end + 2:]
+                if self.length == 0:
+                    self.state = 'trailer'
+                else:
+                    self.state = 'body'
+
+    def start_body(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            self.state = 'chunk'
+        elif self.headers.has_key('content-length'):
+            self.length = int(self.headers['content-length'])
+            self.state = 'body'
+        else:
+            self.length = None
+            self.state = 'body'
+
+    def done(self, keep_alive=True):
+        page = self.page
+        self.page = None
+        if self.version != 'HTTP/1.1' or self.headers.get('connection', '').lower() == 'close':
+            keep_alive = False
+        self.fetcher.page_done(self, page, int(self.status), self.headers, ''.join(self.body))
+        if keep_alive:
+            self.fetcher.connection_idle(self)
+        else:
+            self.close()
+            self.fetcher.connection_closed(self)
+
+    def failed(self, error):
+        page = self.page
+        self.page = None
+        self.fetcher.page_failed(page, error)
+
+class AsyncFetcher(object):
+    """
+    Async fetcher downloads pages with at most host_limit keep-alive connections
+    per host, and parses them with parse(html) (or returns the html if parse is
+    None). It has the fetch_all method of
+    fetcher.Fetcher, so it can be used by fetcher.extract_companies.
+
+    If a page_cache is given, the pages are found in it, and the downloaded
+    pages are put in it.
+    """
+
+    host_limit = 2
+    timeout = 30
+
+    def __init__(self, parse, host_limit=2, proxy=None, page_cache=None, timeout=30):
+        self.parse = parse
+        self.host_limit = host_limit
+        self.proxy = proxy
+        self.page_cache = page_cache
+        self.timeout = timeout
+
+    def fetch_all(self, urls):
+        """
+        Fetch the urls, yields (url, parsed page, error) in the order they are done.
+        error is the reason the page could not be downloaded or parsed (and the
+        parsed page is None), or None.
+        """
+        self.map = {}
+        self.pending = {}
+        self.connections = {}
+        self.results = deque()
+        self.active = 0
+
+        for url in urls:
+            html = None
+            if self.page_cache is not None:
+                html = self.page_cache.get(url)
+            if html is not None:
+                self.results.append((url, html, None))
+            else:
+                self.add([url, url, 0])
+
+        while True:
+            while self.results:
+                url, html, error = self.results.popleft()
+                if error is None and self.parse is None:
+                    yield url, html, None
+                elif error is None:
+                    try:
+                        yield url, self.parse(html), None
+                    except Exception, e:
+                        yield url, None, e
+                else:
+                    yield url, None, error
+
+            if self.active == 0:
+                break
+
+            self.start_connections()
+            asyncore.loop(timeout=0.1, map=self.map, count=1)
+            self.check_timeouts()
+
+        # all done, close the kept-alive connections
+        for c in self.map.values():
+            c.close()
+
+    def add(self, page):
+        """
+        Add the page ([url, current url, redirects]) to the pages to download.
+        """
+        scheme, host = urlparse.urlparse(page[1])[:2]
+        if scheme != 'http':
+            self.results.append((page[0], None, HttpError('Not a http URL: %s' % page[1])))
+            return
+        self.pending.setdefault(host, deque()).append(page)
+        self.active += 1
+
+    def retry(self, page):
+        self.active -= 1
+        self.add(page)
+
+    def start_connections(self):
+        """
+        Give the pending pages to the idle connections of their host, and open
+        new connections (at most host_limit per host) for the rest.
+        """
+        for host, pages in self.pending.items():
+            connections = self.connections.setdefault(host, [])
+            for c in connections:
+                if c.page is None and len(pages) > 0:
+                    self.send(c, pages.popleft())
+            while len(pages) > 0 and len(connections) < self.host_limit:
+                c = HttpConnection(self, host, self.address(host), self.map)
+                connections.append(c)
+                self.send(c, pages.popleft())
+            if len(pages) == 0:
+                del self.pending[host]
+
+    def address(self, host):
+        """
+        The address to connect to for the host (the proxy if there is one).
+        """
+        if self.proxy is not None:
+            return self.proxy
+        if ':' in host:
+            name, port = host.split(':', 1)
+            return (name, int(port))
+        return (host, 80)
+
+    def send(self, connection, page):
+        scheme, host, path, params, query, fragment = urlparse.urlparse(page[1])
+        if self.proxy is None:
+            path = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+        else:
+            path = page[1]
+        connection.send_request(page, path)
+
+    def connection_idle(self, connection):
+        pages = self.pending.get(connection.host)
+        if pages:
+            self.send(connection, pages.popleft())
+
+    def connection_closed(self, connection):
+        connections = self.connections.get(connection.host, [])
+        if connection in connections:
+            connections.remove(connection)
+
+    def page_done(self, connection, page, status, headers, body):
+        self.active -= 1
+        if status in (301, 302, 303, 307) and headers.has_key('location'):
+            if page[2] >= MAX_REDIRECTS:
+                self.page_failed(page, HttpError('Too many redirects: %s' % page[0]), False)
+                return
+            self.add([page[0], urlparse.urljoin(page[1], headers['location']), page[2] + 1])
+        elif status != 200:
+            self.page_failed(page, HttpError('HTTP %d: %s' % (status, page[1])), False)
+        else:
+            if self.page_cache is not None:
+                self.page_cache.put(page[0], body)
+            self.results.append((page[0], body, None))
+
+    def page_failed(self, page, error, active=True):
+        if active:
+            self.active -= 1
+        self.results.append((page[0], None, error))
+
+    def check_timeouts(self):
+        now = time.time()
+        for connections in self.connections.values():
+            for c in list(connections):
+                if c.page is not None and now - c.last_active > self.timeout:
+                    c.failed(HttpError('Timeout: %s' % c.page[1]))
+                    c.close()
+                    self.connection_closed(c)
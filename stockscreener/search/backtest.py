@@ -0,0 +1,102 @@
+import datetime
+from decimal import Decimal
+from django.utils import simplejson
+from models import SavedScreen
+from search import MinMaxCriteria
+from snapshot import ColumnarSnapshot
+import timeseries
+
+"""
+The backtest module runs a saved screen (SavedScreen) at every date in a range
+of dates, and finds the companies matching it at each date, from the history.
+
+The values as of the first date are loaded once (timeseries.values_asof) in a
+columnar snapshot, and the snapshot is moved forward one date at a time with the
+values changed at that date (the changes of the whole range are read with one
+query, see timeseries.changes_between). Only the companies with a changed value
+are matched again, the other companies keep their membership.
+"""
+
+def get_criterias(screen):
+    """
+    Returns the MinMaxCriteria of the saved screen.
+    """
+    def to_value(value):
+        if value is None:
+            return None
+        return Decimal(value)
+
+    return [ MinMaxCriteria(int(stock_property_id), to_value(min_value), to_value(max_value))
+             for stock_property_id, min_value, max_value in simplejson.loads(screen.criterias) ]
+
+def set_criterias(screen, criterias):
+    """
+    Keep the MinMaxCriteria in the saved screen.
+    """
+    def to_text(value):
+        if value is None:
+            return None
+        return str(value)
+
+    screen.criterias = simplejson.dumps([ [c.stock_property_id, to_text(c.min_value), to_text(c.max_value)]
+                                          for c in criterias ])
+
+def save_screen(name, criterias, sector=None, exchange=None):
+    """
+    Save the criterias, sector (id) and exchange of a search as the screen with
+    the name (replacing it if it exists). Returns the SavedScreen.
+    """
+    try:
+        screen = SavedScreen.objects.get(name=name)
+    except SavedScreen.DoesNotExist:
+        screen = SavedScreen(name=name)
+    set_criterias(screen, criterias)
+    if sector is not None and str(sector).strip() == '':
+        sector = None
+    screen.sector_id = sector and int(sector) or None
+    screen.exchange = exchange or ''
+    screen.save()
+    return screen
+
+def backtest(screen, start, end, step=1):
+    """
+    Run the screen at the dates start, start + step days, ... up to end. Yields
+    (date, members, entered, left) for each date, the sorted ids of the companies
+    matching the screen at the date, and of those which started and stopped
+    matching since the previous date (at the first date, all the members entered).
+    step must be 1 or more.
+    """
+    if step <= 0:
+        raise ValueError('step must be 1 or more: %r' % step)
+    criterias = get_criterias(screen)
+    sector = screen.sector_id and str(screen.sector_id) or None
+    exchange = screen.exchange or None
+    step = datetime.timedelta(days=step)
+
+    s = ColumnarSnapshot()
+    s.build(timeseries.values_asof(start))
+    changes = timeseries.changes_between(start, end)
+
+    members = None
+    next_change = 0
+    date = start
+    while date <= end:
+        changed = set()
+        while next_change < len(changes) and changes[next_change][0] <= date:
+            day, symbol_id, stock_property_id, value = changes[next_change]
+            s.set_value(symbol_id, stock_property_id, value)
+            changed.add(symbol_id)
+            next_change += 1
+
+        if members is None:
+            # the first date, all the companies are matched
+            members = set()
+            now = set(s.match(criterias, sector, exchange))
+        else:
+            # only the companies with a changed value are matched again
+            now = (members - changed) | set(s.match(criterias, sector, exchange, ids=changed))
+
+        yield date, sorted(now), sorted(now - members), sorted(members - now)
+
+        members = now
+        date += step
@@ -0,0 +1,248 @@
+import threading, time, os, hashlib
+from django.db import connection, transaction
+
+"""
+The cache module has a small LRU cache, and the data version, which is a counter
+in the database that the importers increase after writing new values.
+
+The web server and the importers are different processes, so a cache in the web
+server compares the data version with the version it was filled at, and is
+cleared when the importers have changed the data.
+"""
+
+# the default of find, to tell a missing key from a value of None
+MISSING = object()
+
+class LRUCache(object):
+    """
+    LRU cache holds at most size values. When it is full, the least recently
+    used value is removed. A size of 0 disables the cache.
+
+    The entries are kept in a doubly linked list, most recently used first,
+    with a map from the key to its entry. Each entry is [prev, next, key, value].
+    """
+
+    size = 0
+    hits = 0
+    misses = 0
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.map = {}
+            # the head of the list, head[1] is the most recently used
+            self.head = [None, None, None, None]
+            self.head[0] = self.head[1] = self.head
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.map)
+
+    def count(self, name):
+        """
+        Add one to the counter with the name, with the lock held (the counters
+        are updated by many threads).
+        """
+        self.lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self.lock.release()
+
+    def get(self, key, default=None):
+        """
+        Get the value of key, or default if it is not in the cache.
+        """
+        value = self.find(key, MISSING)
+        if value is MISSING:
+            self.count('misses')
+            return default
+        self.count('hits')
+        return value
+
+    def find(self, key, default=None):
+        """
+        Get the value of key, or default if it is not in the cache, without
+        counting it as a hit or a miss.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.map.get(key)
+            if entry is None:
+                return default
+            self.__unlink(entry)
+            self.__link_first(entry)
+            return entry[3]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        """
+        Put the value in the cache, removes the least recently used if it is full.
+        """
+        if self.size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            entry = self.map.get(key)
+            if entry is not None:
+                self.__unlink(entry)
+            elif len(self.map) >= self.size:
+                oldest = self.head[0]
+                self.__unlink(oldest)
+                del self.map[oldest[2]]
+                self.evicted(oldest[2], oldest[3])
+            entry = [None, None, key, value]
+            self.map[key] = entry
+            self.__link_first(entry)
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.map.pop(key, None)
+            if entry is not None:
+                self.__unlink(entry)
+        finally:
+            self.lock.release()
+
+    def evicted(self, key, value):
+        """
+        Called when the least recently used value is removed because the cache
+        is full (with the lock held).
+        """
+        pass
+
+    def __unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def __link_first(self, entry):
+        entry[0] = self.head
+        entry[1] = self.head[1]
+        self.head[1][0] = entry
+        self.head[1] = entry
+
+class PageCache(LRUCache):
+    """
+    Page cache holds downloaded pages by URL, at most size pages in memory, and
+    each page for at most ttl seconds. It is used by the Extractor, so a page is
+    only downloaded once during an import.
+
+    If directory is given, the pages removed from memory (because it is full)
+    are written to files in the directory, and read back when asked for again.
+
+    hits count the pages found in memory, disk_hits the pages found in the
+    directory, misses the pages found in neither, and expired the pages that
+    were too old.
+    """
+
+    ttl = None
+    directory = None
+    disk_hits = 0
+    expired = 0
+
+    def __init__(self, size, ttl=3600, directory=None):
+        self.ttl = ttl
+        self.directory = directory
+        LRUCache.__init__(self, size)
+
+    def put(self, key, value):
+        LRUCache.put(self, key, (time.time(), value))
+
+    def get(self, key, default=None):
+        entry = self.find(key)
+        if entry is not None:
+            self.count('hits')
+        elif self.directory is not None:
+            entry = self.read(key)
+            if entry is not None:
+                self.count('disk_hits')
+                LRUCache.put(self, key, entry)
+
+        if entry is None:
+            self.count('misses')
+            return default
+
+        saved, value = entry
+        if self.ttl is not None and time.time() - saved > self.ttl:
+            self.count('expired')
+            self.remove(key)
+            return default
+        return value
+
+    def remove(self, key):
+        LRUCache.remove(self, key)
+        if self.directory is not None and os.path.exists(self.filename(key)):
+            os.remove(self.filename(key))
+
+    def evicted(self, key, value):
+        if self.directory is not None:
+            saved, page = value
+            fd = open(self.filename(key), 'wb')
+            try:
+                fd.write('%r\n' % saved)
+                fd.write(page)
+            finally:
+                fd.close()
+
+    def read(self, key):
+        """
+        Read a page from the directory, returns (time saved, page) or None.
+        """
+        try:
+            fd = open(self.filename(key), 'rb')
+        except IOError:
+            return None
+        try:
+            saved = float(fd.readline())
+            return saved, fd.read()
+        finally:
+            fd.close()
+
+    def filename(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.md5(key).hexdigest())
+
+class DataVersionCache(LRUCache):
+    """
+    LRU cache which is cleared when the data version changes. Call check_version
+    before using the cache.
+    """
+
+    version = None
+
+    def check_version(self):
+        version = get_data_version()
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+def get_data_version():
+    """
+    Returns the data version (0 if the importers never changed anything)
+    """
+    cursor = connection.cursor()
+    cursor.execute("select version from search_dataversion where id = 1")
+    row = cursor.fetchone()
+    if row is None:
+        return 0
+    return row[0]
+
+def bump_data_version():
+    """
+    Increase the data version, the importers call this after writing new values.
+    """
+    cursor = connection.cursor()
+    cursor.execute("update search_dataversion set version = version + 1 where id = 1")
+    if cursor.rowcount == 0:
+        cursor.execute("insert into search_dataversion (id, version) values (1, 1)")
+    transaction.commit_unless_managed()
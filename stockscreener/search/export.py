@@ -0,0 +1,56 @@
+import csv, StringIO
+from django.utils import simplejson
+
+"""
+The export module writes search results as CSV or NDJSON (one JSON object per
+line). Both are generators that write one line at a time, so the results can be
+streamed in the response while they are loaded (see search.iter_results).
+"""
+
+# the export formats: format -> (function, mime type, file extension)
+FORMATS = {}
+
+def csv_lines(headers, results):
+    """
+    Write the results as CSV lines, the first line has the column names: symbol,
+    name and the name of each header. Missing values are empty.
+    """
+    buffer = StringIO.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(row):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow([ to_csv(v) for v in row ])
+        return buffer.getvalue()
+
+    yield line(['symbol', 'name'] + [ h.name for h in headers ])
+    for r in results:
+        yield line([r.symbol.symbol, r.symbol.name] + r.values)
+
+def to_csv(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def ndjson_lines(headers, results):
+    """
+    Write the results as JSON lines, one object per company with the symbol, name
+    and the values by header name. Missing values are null. The values are
+    written as JSON numbers from their decimal text, so no digits are lost.
+    """
+    names = [ simplejson.dumps(h.name) for h in headers ]
+    for r in results:
+        values = ', '.join([ '%s: %s' % (name, to_json(value)) for name, value in zip(names, r.values) ])
+        yield '{"symbol": %s, "name": %s, "values": {%s}}\n' % (simplejson.dumps(r.symbol.symbol),
+                                                                simplejson.dumps(r.symbol.name), values)
+
+def to_json(value):
+    if value is None:
+        return 'null'
+    return str(value)
+
+FORMATS['csv'] = (csv_lines, 'text/csv', 'csv')
+FORMATS['json'] = (ndjson_lines, 'application/x-ndjson', 'json')
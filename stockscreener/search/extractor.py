@@ -1,8 +1,24 @@
 import StringIO, re, decimal, urllib2, xml.dom.minidom, datetime
+from lxml import etree
 from lxml.html import ElementSoup
-from models import StockPropertyValue, Company, Sector, StockPropertyValueHistory
+from django.db.models import signals
+from models import StockProperty, StockPropertyValue, Company, Sector
+import histogram, stats, timeseries
+from cache import LRUCache, PageCache
 import stockscreener.settings as settings
 
+# the ntlmaps proxy, used if settings has USE_PROXY set
+PROXY = '127.0.0.1:5865'
+
+def get_proxy():
+    """
+    Returns the (host, port) of the proxy to use, or None for no proxy (see get_opener)
+    """
+    if settings.USE_PROXY:
+        host, port = PROXY.split(':')
+        return (host, int(port))
+    return None
+
 def get_opener(other=None):
     """
     The purpose of the opener method is to create an URL-opener, which
@@ -12,7 +28,7 @@ def get_opener(other=None):
     handlers = []
     # if settings has USE_PROXY set, then we use the ntmlaps proxy
     if settings.USE_PROXY:
-        proxy_handler = urllib2.ProxyHandler({'http':'127.0.0.1:5865'})
+        proxy_handler = urllib2.ProxyHandler({'http':PROXY})
         handlers.append(proxy_handler)
 
     if other is not None:
@@ -61,6 +77,79 @@ def convert_ssi_units(value):
         val, unit = m.group(1), m.group(2)
         return decimal.Decimal(val.replace(',','')) * ssi[unit.lower()]
 
+# the number of compiled xpaths and convert expressions kept
+COMPILED_CACHE_SIZE = 1000
+
+# the compiled xpaths by their text, used by find_text (also in the processes
+# of a parse pool, which only get the text of the xpaths)
+compiled_xpaths = LRUCache(COMPILED_CACHE_SIZE)
+
+# the compiled convert expressions by stock property id, as (convert expression,
+# code), they are removed when the stock property is saved (see property_changed)
+compiled_converters = LRUCache(COMPILED_CACHE_SIZE)
+
+def compile_xpath(xml_path):
+    """
+    Returns the compiled xpath (lxml.etree.XPath), it is compiled once.
+    """
+    xpath = compiled_xpaths.get(xml_path)
+    if xpath is None:
+        xpath = etree.XPath(xml_path)
+        compiled_xpaths.put(xml_path, xpath)
+    return xpath
+
+def compile_converter(stock_property):
+    """
+    Returns the compiled convert expression of the stock property, it is compiled
+    once. The text is compared too, as the stock property can be changed in
+    another process (the admin runs in the web server, not in the importer).
+    """
+    expression = stock_property.convert_expression
+    compiled = compiled_converters.get(stock_property.id)
+    if compiled is None or compiled[0] != expression:
+        compiled = (expression, compile(expression, '<convert %s>' % stock_property.id, 'eval'))
+        if stock_property.id is not None:
+            compiled_converters.put(stock_property.id, compiled)
+    return compiled[1]
+
+def property_changed(sender, instance, **kwargs):
+    """
+    Forget the compiled convert expression of a stock property edited (or removed)
+    in this process.
+    """
+    compiled_converters.remove(instance.id)
+
+signals.post_save.connect(property_changed, sender=StockProperty)
+signals.post_delete.connect(property_changed, sender=StockProperty)
+
+def parse_html(html):
+    """
+    Parse the html page (soup-style, it does not have to be valid).
+    """
+    return ElementSoup.parse(StringIO.StringIO(html))
+
+def find_text(doc, xml_path):
+    """
+    Evaluate the xpath in the parsed page, returns the text of the first element
+    found, or None if there is no element.
+    """
+    elem = compile_xpath(xml_path)(doc)
+    if elem is None or len(elem) == 0:
+        return None
+    else:
+        return elem[0].text
+
+def find_texts(html, xml_paths):
+    """
+    Parse the html page, and find the text of each of the xpaths in it. Returns
+    the texts in the order of the xml_paths.
+
+    It is called by the processes of a parse pool (see fetcher.extract_companies),
+    so it only gets and returns strings, not the parsed page or the models.
+    """
+    doc = parse_html(html)
+    return [ find_text(doc, xml_path) for xml_path in xml_paths ]
+
 class Extractor:
     """
     Extractor class will handle the task to get a value for a stock property, given
@@ -70,59 +159,178 @@ class Extractor:
     2) find the value in the downloaded HTML page (execute_xpath method)
     3) convert the value from the HTML page into something usable (execute_converter method)
 
-    The extract method does all these steps, and also has a simple cache function, so
-    I do not download the same page many times (it only caches one web-page)
+    The extract method does all these steps, and saves the value (or gives it to
+    the writer, a writer.ValueWriter, if there is one). The downloaded pages are
+    kept in the page_cache (a PageCache, see settings.PAGE_CACHE_SIZE), so I do not
+    download the same page many times during an import, and the last page is kept
+    parsed.
+
+    The extract_all method extracts many stock properties for a company, and
+    downloads and parses each page only once, no matter how many stock properties
+    are found in it. The save_texts method does step 3 (and saves) for texts
+    found in the pages somewhere else, like in a parse pool.
     """
 
     last_page = None
     last_url = None
+    last_doc = None
+
+    page_cache = None
+    writer = None
+
+    def __init__(self, page_cache=None, writer=None):
+        if page_cache is None:
+            page_cache = PageCache(getattr(settings, 'PAGE_CACHE_SIZE', 100),
+                                   getattr(settings, 'PAGE_CACHE_TTL', 3600),
+                                   getattr(settings, 'PAGE_CACHE_DIR', None))
+        self.page_cache = page_cache
+        self.writer = writer
 
     def extract(self, company, stock_property):
 
-        symbol = company.reuters_symbol
+        # download and parse page, cache last page
+        doc = self.get_document(self.get_url(company, stock_property))
 
-        # download page, cache last page
-        url = stock_property.url.replace('SYMBOL', symbol)
-        if self.last_url == url:
-            html = self.last_page
-        else:
+        return self.extract_from(doc, company, stock_property)
+
+    def extract_all(self, company, stock_properties, documents=None):
+        """
+        Extract the stock properties for the company. The stock properties are
+        grouped by their page, so each page is downloaded and parsed once, and
+        the values are found in the same parsed page.
+
+        documents can have the parsed pages by url, if they are already fetched
+        (see the fetcher module), a page missing in it (or None) has no values.
+
+        Returns a list of (stock property, value) in the order of the stock
+        properties, the value is None if it was not found.
+        """
+        pages = {}
+        for stock_property in stock_properties:
+            pages.setdefault(self.get_url(company, stock_property), []).append(stock_property)
+
+        texts = {}
+        for url, page_properties in pages.items():
+            if documents is None:
+                doc = self.get_document(url)
+            else:
+                doc = documents.get(url)
+            for stock_property in page_properties:
+                if doc is not None:
+                    texts[stock_property.id] = self.execute_xpath_doc(doc, stock_property.xml_path)
+
+        return self.save_texts(company, stock_properties, texts)
+
+    def save_texts(self, company, stock_properties, texts):
+        """
+        Convert and save the texts found for the stock properties of the company,
+        texts is {stock property id: text}, a stock property missing in it (or
+        None) is not found.
+
+        Returns a list of (stock property, value) in the order of the stock
+        properties, the value is None if it was not found.
+        """
+        found = []
+        for stock_property in stock_properties:
+            text = texts.get(stock_property.id)
+            if text is None:
+                found.append((stock_property, None))
+            else:
+                found.append((stock_property, self.save_text(company, stock_property, text)))
+        return found
+
+    def get_url(self, company, stock_property):
+        return stock_property.url.replace('SYMBOL', company.reuters_symbol)
+
+    def fetch_document(self, url):
+        """
+        Download (or find in the page_cache) and parse the page. It does not use
+        the last page, so it can be called by many threads (see the fetcher module).
+        """
+        return self.parse(self.fetch_page(url))
+
+    def fetch_page(self, url):
+        """
+        Download (or find in the page_cache) the html of the page, without parsing
+        it. It can be called by many threads.
+        """
+        html = self.page_cache.get(url)
+        if html is None:
             html = self.download(url)
+            self.page_cache.put(url, html)
+        return html
+
+    def get_document(self, url):
+        """
+        Download and parse the page, the pages are cached in the page_cache, and
+        the last page is kept parsed.
+        """
+        if self.last_url != url or self.last_doc is None:
+            html = self.page_cache.get(url)
+            if html is None:
+                html = self.download(url)
+                self.page_cache.put(url, html)
             self.last_url = url
             self.last_page = html
-            
+            self.last_doc = self.parse(html)
+        return self.last_doc
+
+    def extract_from(self, doc, company, stock_property):
+        """
+        Find the value of the stock property in the parsed page, convert it and
+        save it for the company.
+        """
+
         # extract the value from page
-        value = self.execute_xpath(html, stock_property.xml_path)
+        value = self.execute_xpath_doc(doc, stock_property.xml_path)
         if value is None:
             return None
-        
+
+        return self.save_text(company, stock_property, value)
+
+    def save_text(self, company, stock_property, value):
+        """
+        Convert the text found for the stock property, and save it for the company.
+        If the extractor has a writer (see the writer module), the value is given
+        to it, and saved with the other values of its batch.
+        """
+
         # convert the extracted value
         converted = self.execute_converter(value,stock_property)
         if converted is None:
             return None
 
+        if self.writer is not None:
+            return self.writer.add(company, stock_property, converted)
+
         # Old values finding
         try:
             sp_value = StockPropertyValue.objects.get(stock_property = stock_property,
                                                       symbol = company)
+            old_value = sp_value.value
             sp_value.value = converted
 
         except StockPropertyValue.DoesNotExist:
+            old_value = None
             sp_value = StockPropertyValue(stock_property = stock_property,
                                           value = converted,
                                           symbol = company)
 
+        # there is no historical value yet, or the newest (kept in the value, so
+        # the history is not read) is not the same as the value we converted.
+        add_history = sp_value.history_value != converted
+        sp_value.history_value = converted
+
         sp_value.save()
 
-        # create historical item.
-        hist_values = StockPropertyValueHistory.objects.filter(current_value = sp_value).order_by('-historical_date')
+        # keep the histogram and statistics up to date (the in-memory snapshot is
+        # patched by the post_save signal, see the snapshot module)
+        histogram.value_changed(stock_property.id, old_value, converted)
+        stats.value_changed(stock_property.id, old_value, converted)
 
-        # there is no historical value yet, or the first (sorted, so newest) is
-        # not the same as the value we converted.
-        if len(hist_values) == 0 or hist_values[0].historical_value != converted:
-            hist_value = StockPropertyValueHistory(current_value=sp_value,
-                                                   historical_value=converted,
-                                                   historical_date=datetime.date.today())
-            hist_value.save()
+        # create historical item (in the history backend, see the timeseries module).
+        if add_history:
+            timeseries.add_history([(sp_value.id, converted, datetime.date.today())])
 
         return sp_value
 
@@ -134,27 +342,27 @@ class Extractor:
         fd.close()
         return html
 
+    # parse the html
+    def parse(self, html):
+        return parse_html(html)
+
     # evaluate the xpath and save it in object.
     def execute_xpath(self, html, xml_path):
-        # parse the html
-        doc = ElementSoup.parse(StringIO.StringIO(html))
-        elem = doc.xpath(xml_path)
+        return self.execute_xpath_doc(self.parse(html), xml_path)
 
-        # if there is no element, return None, otherwise return the contents.        
-        if elem is None or len(elem) == 0:
-            return None
-        else:
-            return elem[0].text
+    # evaluate the xpath in the parsed html
+    def execute_xpath_doc(self, doc, xml_path):
+        return find_text(doc, xml_path)
 
     def execute_converter(self, value,stock_property):
-        # setup ssi function in local scope
-        SSI = convert_ssi_units
-        # setup USD function in local scop
-        USD = usd_to_value
-        # setup value as 'x' variable
-        x = value
-        # evaluate x using the convert_expession of the the stock property
-        converted = eval(stock_property.convert_expression)
+        # setup ssi function, USD function and value as 'x' variable in local scope
+        scope = {'SSI': convert_ssi_units,
+                 'USD': usd_to_value,
+                 'x': value,
+                 'value': value,
+                 'stock_property': stock_property}
+        # evaluate x using the (compiled) convert_expession of the the stock property
+        converted = eval(compile_converter(stock_property), globals(), scope)
         # return as decimal, if it is already, then do nothing, otherwise try to convert
         try:
             if isinstance(converted, decimal.Decimal):
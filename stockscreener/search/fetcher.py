@@ -0,0 +1,225 @@
+import threading, time, urlparse, Queue
+from collections import deque
+from extractor import find_texts
+
+"""
+The fetcher module downloads (and parses) many pages at the same time with a
+pool of worker threads, so an import is not waiting for one page at a time.
+
+To be polite to the web sites, at most host_limit pages are downloaded from the
+same host at the same time, with at least host_delay seconds between starting
+two downloads from the same host.
+
+The pages are only downloaded and parsed by the workers, the values are found
+and saved to the database by the thread asking for the pages (see
+extract_companies).
+
+Parsing the pages takes a lot of CPU, and threads only use one core, so the
+pages can be parsed by a pool of processes instead (multiprocessing.Pool, see
+importall --processes): the workers only download the html, the processes parse
+it and find the texts of the stock properties, and only the texts are sent
+back to be converted and saved.
+"""
+
+class Fetcher(object):
+    """
+    Fetcher calls fetch(url) for many urls with a number of worker threads, and
+    returns the results as they are done.
+    """
+
+    workers = 4
+    host_limit = 2
+    host_delay = 0.0
+
+    def __init__(self, fetch, workers=4, host_limit=2, host_delay=0.0):
+        self.fetch = fetch
+        self.workers = workers
+        self.host_limit = host_limit
+        self.host_delay = host_delay
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def fetch_all(self, urls):
+        """
+        Fetch the urls, yields (url, result, error) in the order they are done.
+        error is the exception raised by fetch (and result is None), or None.
+        """
+        urls = list(urls)
+        if len(urls) == 0:
+            return
+
+        todo = Queue.Queue()
+        done = Queue.Queue()
+        for url in urls:
+            todo.put(url)
+
+        threads = []
+        for i in range(min(self.workers, len(urls))):
+            todo.put(None)
+            t = threading.Thread(target=self.work, args=(todo, done))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        for i in range(len(urls)):
+            yield done.get()
+
+        for t in threads:
+            t.join()
+
+    def work(self, todo, done):
+        """
+        The worker thread, fetches urls until it gets None.
+        """
+        while True:
+            url = todo.get()
+            if url is None:
+                break
+            host = self.acquire(url)
+            try:
+                try:
+                    done.put((url, self.fetch(url), None))
+                except Exception, e:
+                    done.put((url, None, e))
+            finally:
+                self.release(host)
+
+    def acquire(self, url):
+        """
+        Wait until a page can be downloaded from the host of the url, returns the host.
+        """
+        host = urlparse.urlparse(url)[1]
+
+        self.lock.acquire()
+        try:
+            if not self.hosts.has_key(host):
+                # [number of downloads allowed, time of the last download]
+                self.hosts[host] = [threading.Semaphore(self.host_limit), 0.0]
+            limit = self.hosts[host]
+        finally:
+            self.lock.release()
+
+        limit[0].acquire()
+
+        # wait host_delay after the last download started
+        self.lock.acquire()
+        try:
+            start = max(time.time(), limit[1] + self.host_delay)
+            limit[1] = start
+        finally:
+            self.lock.release()
+        wait = start - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        return host
+
+    def release(self, host):
+        self.hosts[host][0].release()
+
+def fetch_companies(extractor, companies, stock_properties, fetcher):
+    """
+    Fetch the pages of the companies with the fetcher, and yield (company, {url:
+    page}) as soon as all the pages of a company are fetched. A page that could
+    not be fetched is printed, and it is None.
+    """
+    # the pages of each company, and the companies waiting for each page (the
+    # pages are fetched in the order of the companies)
+    missing = {}
+    waiting = {}
+    pages = []
+    for company in companies:
+        urls = set([ extractor.get_url(company, p) for p in stock_properties ])
+        missing[company.id] = [company, urls, {}]
+        for url in urls:
+            if not waiting.has_key(url):
+                pages.append(url)
+            waiting.setdefault(url, []).append(company.id)
+
+    for url, page, error in fetcher.fetch_all(pages):
+        if error is not None:
+            print "Could not fetch %s: %s" % (url, error)
+
+        for company_id in waiting[url]:
+            company, urls, found = missing[company_id]
+            found[url] = page
+            urls.discard(url)
+            if len(urls) == 0:
+                del missing[company_id]
+                yield company, found
+
+def extract_companies(extractor, companies, stock_properties, fetcher, pool=None):
+    """
+    Extract the stock properties for the companies, the pages are fetched by the
+    fetcher (with extractor.fetch_document), and the values are found and saved
+    in this thread as soon as all the pages of a company are fetched.
+
+    If pool (a multiprocessing.Pool) is given, the fetcher must return the html
+    of the pages (extractor.fetch_page), the pages are parsed and the texts are
+    found by the processes of the pool, and only converted and saved here.
+
+    Yields (company, [(stock property, value)]) in the order the companies are done.
+    A page that could not be fetched is printed, and its values are None.
+    """
+    fetched = fetch_companies(extractor, companies, stock_properties, fetcher)
+
+    if pool is None:
+        for company, documents in fetched:
+            yield company, extractor.extract_all(company, stock_properties, documents)
+        return
+
+    # the companies sent to the pool, they are saved in the same order
+    running = deque()
+    for company, pages in fetched:
+        running.append((company, start_texts(extractor, company, stock_properties, pages, pool)))
+        while len(running) > 0 and texts_ready(running[0][1]):
+            company, jobs = running.popleft()
+            yield company, extractor.save_texts(company, stock_properties, get_texts(jobs))
+
+    while len(running) > 0:
+        company, jobs = running.popleft()
+        yield company, extractor.save_texts(company, stock_properties, get_texts(jobs))
+
+def start_texts(extractor, company, stock_properties, pages, pool):
+    """
+    Send the pages of the company to the pool, to find the texts of the stock
+    properties in them. Returns [(stock properties of the page, result)], where
+    result is the AsyncResult of the page (or None if the page was not fetched).
+    """
+    page_properties = {}
+    for stock_property in stock_properties:
+        page_properties.setdefault(extractor.get_url(company, stock_property), []).append(stock_property)
+
+    jobs = []
+    for url, properties in page_properties.items():
+        html = pages.get(url)
+        if html is None:
+            jobs.append((properties, None))
+        else:
+            xml_paths = [ p.xml_path for p in properties ]
+            jobs.append((properties, pool.apply_async(find_texts, (html, xml_paths))))
+    return jobs
+
+def texts_ready(jobs):
+    for properties, result in jobs:
+        if result is not None and not result.ready():
+            return False
+    return True
+
+def get_texts(jobs):
+    """
+    Wait for the texts of the pages, returns {stock property id: text}. A page
+    that could not be parsed is printed, and its texts are missing.
+    """
+    texts = {}
+    for properties, result in jobs:
+        if result is None:
+            continue
+        try:
+            found = result.get()
+        except Exception, e:
+            print "Could not parse %s: %s" % (properties[0].url, e)
+            continue
+        for stock_property, text in zip(properties, found):
+            texts[stock_property.id] = text
+    return texts
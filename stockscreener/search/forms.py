@@ -3,7 +3,7 @@ import re
 from decimal import Decimal
 from django import forms
 from models import StockProperty, Company, Sector
-from search import MinMaxCriteria
+from search import MinMaxCriteria, PropertyOrder
 
 """
 The forms module handles the forms in the django application.
@@ -39,10 +39,21 @@ def load_criterias():
     l.insert(0, ('', 'Select to add criteria ...'))
     return l
 
+def load_orders():
+    """
+    Helper function to provide a list of StockProperties to sort the result by
+    """
+    l = [ (p.id, p.name) for p in StockProperty.objects.all() ]
+    l.insert(0, ('', 'Sort by ...'))
+    return l
+
 class SearchForm(forms.Form):
     """
     The search form represents the search form. It has a list of static fields
-    which are using the Django framework to handle: sector, exchange, add_criteria, show_result
+    which are using the Django framework to handle: sector, exchange, add_criteria, show_result,
+    order_by and direction
+
+    asof is the date to screen the values as of (empty for the current values).
 
     It also has minmax_criteria which is dynamic, and we have the helper function
     find_minmax_criteria to handle those.
@@ -60,6 +71,17 @@ class SearchForm(forms.Form):
 
     show_result = forms.ChoiceField(choices=SHOW_RESULT, required=True)
 
+    DIRECTIONS = (
+        ('asc', 'Lowest first'),
+        ('desc', 'Highest first'))
+
+    order_by = forms.ChoiceField(choices=load_orders(), required=False, initial='')
+    direction = forms.ChoiceField(choices=DIRECTIONS, required=False, initial='asc')
+
+    asof = forms.DateField(required=False)
+    asof.widget.attrs['title'] = 'Screen as of a date in the past (YYYY-MM-DD), empty for today'
+    asof.widget.attrs['size'] = '10'
+
     minmax_criteria = None
 
     def find_minmax_criteria(self, data):
@@ -103,3 +125,13 @@ class SearchForm(forms.Form):
             c.extend(self.minmax_criteria.values())
 
         return c
+
+    def to_order(self):
+        """
+        Creates the PropertyOrder to sort the result by, None if not selected
+        (call is_valid first).
+        """
+        order_by = self.cleaned_data.get('order_by')
+        if order_by is None or order_by == '':
+            return None
+        return PropertyOrder(int(order_by), self.cleaned_data.get('direction') or 'asc')
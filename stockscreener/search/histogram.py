@@ -0,0 +1,115 @@
+from decimal import Decimal
+from models import StockProperty, StockPropertyValue, StockPropertyHistogram
+from DistrGraph import GraphHelper, count_values, range_index
+
+"""
+The histogram module keeps the distribution of the values of each stock property
+in the database (StockPropertyHistogram), so the distribution graph is not
+counted again on every view.
+
+The histograms are built by the importers after importing (update_histograms),
+and when the extractor changes a single value, only the two ranges of the old
+and new value are changed (value_changed).
+"""
+
+# the number of ranges in a histogram (the x size of the distribution graph)
+HISTOGRAM_BUCKETS = 50
+
+# the quantiles kept in a histogram
+QUANTILES = (Decimal('0.25'), Decimal('0.5'), Decimal('0.75'))
+
+def build_histogram(stock_property_id, values=None):
+    """
+    Count the values of the stock property, and save the histogram. values are
+    loaded from the database if not given. Returns the histogram, or None if the
+    stock property has no values (then the histogram is removed).
+    """
+    if values is None:
+        values = StockPropertyValue.objects.filter(stock_property__id=stock_property_id).values_list('value', flat=True)
+    values = sorted(values)
+
+    try:
+        histogram = StockPropertyHistogram.objects.get(stock_property__id=stock_property_id)
+    except StockPropertyHistogram.DoesNotExist:
+        histogram = StockPropertyHistogram(stock_property_id=stock_property_id)
+
+    if len(values) == 0:
+        if histogram.id is not None:
+            histogram.delete()
+        return None
+
+    histogram.min_value = values[0]
+    histogram.max_value = values[-1]
+    histogram.set_counts(count_values(values, values[0], values[-1], HISTOGRAM_BUCKETS))
+    histogram.set_quantiles([ values[int(q * (len(values) - 1))] for q in QUANTILES ])
+    histogram.save()
+    return histogram
+
+def update_histograms():
+    """
+    Build the histograms of all the stock properties, the importers call this
+    after importing.
+    """
+    for stock_property_id in StockProperty.objects.values_list('id', flat=True):
+        build_histogram(stock_property_id)
+
+def value_changed(stock_property_id, old_value, new_value):
+    """
+    Update the histogram after a value of the stock property is changed from
+    old_value to new_value (old_value is None for a new value).
+
+    The value is moved to its new range, and the quantiles are estimated from the
+    ranges. If there is no histogram yet, or the new value is outside it, it is
+    built again.
+    """
+    if old_value == new_value:
+        return
+
+    try:
+        histogram = StockPropertyHistogram.objects.get(stock_property__id=stock_property_id)
+    except StockPropertyHistogram.DoesNotExist:
+        # not built yet, count the values of the stock property
+        build_histogram(stock_property_id)
+        return
+
+    a, b = histogram.min_value, histogram.max_value
+    if new_value < a or new_value > b or old_value in (a, b):
+        # the min or max changes, so all the ranges change
+        build_histogram(stock_property_id)
+        return
+
+    counts = histogram.get_counts()
+    diff = (b - a) / len(counts)
+    if old_value is not None:
+        i = range_index(old_value, a, diff, len(counts))
+        counts[i] = max(0, counts[i] - 1)
+    counts[range_index(new_value, a, diff, len(counts))] += 1
+
+    histogram.set_counts(counts)
+    histogram.set_quantiles([ estimate_quantile(counts, a, b, q) for q in QUANTILES ])
+    histogram.save()
+
+def estimate_quantile(counts, a, b, q):
+    """
+    Estimate the value at the quantile q from the number of values in each range
+    between a and b, assuming the values are spread evenly inside a range.
+    """
+    diff = (b - a) / len(counts)
+    rank = q * (sum(counts) - 1)
+    seen = 0
+    for i, count in enumerate(counts):
+        if count > 0 and seen + count > rank:
+            return a + diff * i + diff * (rank - seen) / count
+        seen += count
+    return b
+
+def get_data(stock_property_id):
+    """
+    Returns the data for the distribution graph from the saved histogram (see
+    GraphHelper.create_data), or None if there is no histogram.
+    """
+    try:
+        histogram = StockPropertyHistogram.objects.get(stock_property__id=stock_property_id)
+    except StockPropertyHistogram.DoesNotExist:
+        return None
+    return GraphHelper().create_grouped_values(histogram.get_counts(), histogram.min_value, histogram.max_value)
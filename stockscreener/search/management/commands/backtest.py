@@ -0,0 +1,72 @@
+
+from django.core.management.base import LabelCommand, CommandError
+from optparse import make_option
+import csv, datetime, sys, time
+from stockscreener.search.models import Company, SavedScreen
+from stockscreener.search.backtest import backtest
+
+class Command(LabelCommand):
+
+    help = 'Run a saved screen at every date in a range, and write the companies matching it at each date as CSV.'
+    args = '[screen]'
+    label = 'screen'
+
+    option_list = LabelCommand.option_list + (
+        make_option('--start', dest='start', default=None,
+                    help="The first date (YYYY-MM-DD)"),
+        make_option('--end', dest='end', default=None,
+                    help="The last date (YYYY-MM-DD), today if not given"),
+        make_option('--step', dest='step', type='int', default=1,
+                    help="The number of days between the dates (1 or more)"),
+        make_option('--output', dest='output', default=None,
+                    help="The CSV file to write, the standard output if not given"),
+    )
+
+    requires_model_validation = True
+
+    def handle_label(self, name, directory=None, **options):
+
+        try:
+            screen = SavedScreen.objects.get(name=name)
+        except SavedScreen.DoesNotExist:
+            raise CommandError("Unknown screen: %s" % name)
+
+        if options.get('start') is None:
+            raise CommandError("The first date (--start) is needed")
+        start = self.to_date(options['start'])
+        end = datetime.date.today()
+        if options.get('end') is not None:
+            end = self.to_date(options['end'])
+        step = options.get('step')
+        if step is None:
+            step = 1
+        if step <= 0:
+            raise CommandError("The step (--step) must be 1 day or more")
+
+        symbols = dict(Company.objects.values_list('id', 'symbol'))
+        def to_symbols(ids):
+            return ' '.join([ symbols.get(id, str(id)) for id in ids ])
+
+        output = sys.stdout
+        if options.get('output') is not None:
+            output = open(options['output'], 'wb')
+
+        # one row per date: the number of companies matching, and the companies
+        # which started and stopped matching since the previous date
+        started = time.time()
+        writer = csv.writer(output)
+        writer.writerow(['date', 'count', 'entered', 'left'])
+        dates = 0
+        for date, members, entered, left in backtest(screen, start, end, step):
+            writer.writerow([date.isoformat(), len(members), to_symbols(entered), to_symbols(left)])
+            dates += 1
+
+        if output is not sys.stdout:
+            output.close()
+            print "Dates=%d, seconds=%.1f" % (dates, time.time() - started)
+
+    def to_date(self, text):
+        try:
+            return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError("Not a date (YYYY-MM-DD): %s" % text)
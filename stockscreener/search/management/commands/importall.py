@@ -1,8 +1,15 @@
 
-from django.core.management.base import LabelCommand
+from django.core.management.base import LabelCommand, CommandError
+import multiprocessing
 from optparse import make_option
 from stockscreener.search.models import Company, StockProperty
-from stockscreener.search.extractor import Extractor
+from stockscreener.search.extractor import Extractor, get_proxy
+from stockscreener.search.fetcher import Fetcher, extract_companies
+from stockscreener.search.asyncfetcher import AsyncFetcher
+from stockscreener.search.writer import ValueWriter
+from stockscreener.search.cache import bump_data_version
+from stockscreener.search.histogram import update_histograms
+from stockscreener.search.stats import update_stats
 
 class Command(LabelCommand):
 
@@ -10,11 +17,21 @@ class Command(LabelCommand):
     args = '[number]'
     label = 'number'
 
+    option_list = LabelCommand.option_list + (
+        make_option('--engine', dest='engine', default=None,
+                    help="How the pages are downloaded: 'threads' (the default, see IMPORT_WORKERS) or 'async' (one thread, keep-alive connections)"),
+        make_option('--processes', dest='processes', type='int', default=None,
+                    help="The number of processes parsing the pages (see IMPORT_PARSE_PROCESSES), 0 parses them in the download threads"),
+        make_option('--batch', dest='batch', type='int', default=None,
+                    help="The number of values written in one transaction (see IMPORT_WRITE_BATCH)"),
+    )
+
     requires_model_validation = True
 
     extractor = Extractor()
     
     def handle_label(self, number, directory=None, **options):
+        from django.conf import settings
 
         stock_properties = StockProperty.objects.all()
         symbols = Company.objects.all()
@@ -23,16 +40,61 @@ class Command(LabelCommand):
 
         number = int(number)
 
-        count = 1
-        for symbol in symbols:
+        # the pages are downloaded and parsed by IMPORT_WORKERS threads (or by the
+        # async fetcher), and the values of a company are saved when all its
+        # pages are downloaded
+        engine = options.get('engine') or getattr(settings, 'IMPORT_ENGINE', 'threads')
 
-            if count > number:
-                break
+        # with a pool of processes, the fetcher only downloads the html, and the
+        # processes parse it (only the found texts are sent back)
+        processes = options.get('processes')
+        if processes is None:
+            processes = getattr(settings, 'IMPORT_PARSE_PROCESSES', 0)
+        pool = None
+        parse, fetch = self.extractor.parse, self.extractor.fetch_document
+        if processes > 0:
+            pool = multiprocessing.Pool(processes)
+            parse, fetch = None, self.extractor.fetch_page
 
-            count = count+1
-            
-            for stock_property in stock_properties:
-                found = self.extractor.extract(symbol, stock_property)
-                print "Extracting %s for %s -> %s" % (stock_property.name, symbol.symbol, str(found))
+        if engine == 'async':
+            fetcher = AsyncFetcher(parse,
+                                   getattr(settings, 'IMPORT_HOST_LIMIT', 2),
+                                   get_proxy(),
+                                   self.extractor.page_cache)
+        elif engine == 'threads':
+            fetcher = Fetcher(fetch,
+                              getattr(settings, 'IMPORT_WORKERS', 4),
+                              getattr(settings, 'IMPORT_HOST_LIMIT', 2),
+                              getattr(settings, 'IMPORT_HOST_DELAY', 0.0))
+        else:
+            raise CommandError("Unknown engine: %s" % engine)
+
+        # the values are written in batches, one transaction per batch
+        batch = options.get('batch') or getattr(settings, 'IMPORT_WRITE_BATCH', 500)
+        writer = ValueWriter(batch)
+        self.extractor.writer = writer
+
+        try:
+            for symbol, values in extract_companies(self.extractor, symbols[:number], stock_properties, fetcher, pool):
+                for stock_property, found in values:
+                    print "Extracting %s for %s -> %s" % (stock_property.name, symbol.symbol, str(found))
+            writer.flush()
+        finally:
+            self.extractor.writer = None
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        print "Written: values=%d, batches=%d" % (writer.written, writer.batches)
+
+        cache = self.extractor.page_cache
+        print "Page cache: hits=%d, disk hits=%d, misses=%d, expired=%d" % (cache.hits, cache.disk_hits, cache.misses, cache.expired)
+
+        # count the distribution graphs and statistics again
+        update_histograms()
+        update_stats()
+
+        # tell the web server that the values are changed
+        bump_data_version()
 
             
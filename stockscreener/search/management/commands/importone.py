@@ -14,16 +14,24 @@ class Command(LabelCommand):
         from django.conf import settings
         from stockscreener.search.models import StockProperty, Company
         from stockscreener.search.extractor import Extractor
+        from stockscreener.search.cache import bump_data_version
 
         stock_properties = StockProperty.objects.all()
 
-        for stock_property in stock_properties:
+        found = Company.objects.filter(symbol=symbol)
 
-            found = Company.objects.filter(symbol=symbol)
-            
-            print "Extracting %s for %s" % (stock_property.name, symbol)
-            # create instance of Extractor (construct an object of class Extractor)
-            extractor = Extractor()
-            # call method extract on the instance of Extractor
-            extractor.extract(found[0], stock_property)
+        # create instance of Extractor (construct an object of class Extractor)
+        extractor = Extractor()
+        # call method extract_all on the instance of Extractor, it downloads and
+        # parses each page once for all its stock properties. The histograms and
+        # statistics are updated for each value it saves, so they are not
+        # counted again here (importall counts them once after importing).
+        for stock_property, value in extractor.extract_all(found[0], stock_properties):
+            print "Extracting %s for %s -> %s" % (stock_property.name, symbol, str(value))
+
+        cache = extractor.page_cache
+        print "Page cache: hits=%d, disk hits=%d, misses=%d, expired=%d" % (cache.hits, cache.disk_hits, cache.misses, cache.expired)
+
+        # tell the web server that the values are changed
+        bump_data_version()
 
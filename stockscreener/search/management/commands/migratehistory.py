@@ -0,0 +1,24 @@
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from stockscreener.search.timeseries import migrate_history
+
+class Command(BaseCommand):
+
+    help = 'Copy the historical values to the compact series (see HISTORY_BACKEND).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--delete', action='store_true', dest='delete', default=False,
+                    help="Delete the StockPropertyValueHistory rows after copying them"),
+        make_option('--batch', dest='batch', type='int', default=10000,
+                    help="The number of historical values read at a time"),
+    )
+
+    requires_model_validation = True
+
+    def handle(self, *args, **options):
+
+        copied = migrate_history(options.get('delete'), options.get('batch'))
+
+        print "Copied %d historical values" % copied
+        print "Set HISTORY_BACKEND = 'series' in settings.py to use them"
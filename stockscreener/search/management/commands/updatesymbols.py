@@ -2,6 +2,7 @@
 from django.core.management.base import BaseCommand
 from optparse import make_option
 from stockscreener.search.extractor import SymbolsClient
+from stockscreener.search.cache import bump_data_version
 
 class Command(BaseCommand):
 
@@ -15,4 +16,7 @@ class Command(BaseCommand):
 
         self.symbolsclient.load_symbols()
 
+        # tell the web server that the companies are changed
+        bump_data_version()
+
         print "All OK ;-)"            
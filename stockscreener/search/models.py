@@ -1,3 +1,5 @@
+import math
+from decimal import Decimal
 from django.db import models
 
 """
@@ -78,6 +80,15 @@ class StockPropertyValue(models.Model):
     symbol = models.ForeignKey(Company)
     value = models.DecimalField(max_digits=19, decimal_places=5)
     stock_property = models.ForeignKey(StockProperty)
+    # the newest historical value (None if there is no history), so the
+    # importers know if a historical value must be added without reading the
+    # history. Existing databases get it from install/history.sql
+    history_value = models.DecimalField(max_digits=19, decimal_places=5, null=True, editable=False)
+
+    class Meta:
+        # one current value per company and stock property. The composite
+        # indexes used by the search are in sql/stockpropertyvalue.sql
+        unique_together = (('symbol', 'stock_property'),)
 
     def __str__(self):
         return "%.2f" % self.value
@@ -86,9 +97,117 @@ class StockPropertyValueHistory(models.Model):
     """
     Stock property value history holds the historical values for a given
     stock property value.  It is related as  a 1:M to a stockproperty value.
+
+    The (current_value, historical_date) index is in sql/stockpropertyvaluehistory.sql
     """
 
     current_value = models.ForeignKey(StockPropertyValue)
 
     historical_value = models.DecimalField(max_digits=19, decimal_places=5)
     historical_date = models.DateField()
+
+class StockPropertySeries(models.Model):
+    """
+    Stock property series holds one year of the historical values of a stock
+    property value, packed in two arrays, instead of a StockPropertyValueHistory
+    row per value (see settings.HISTORY_BACKEND and the timeseries module).
+
+    days are the days in the year (0 is January 1st), as little-endian 16 bit
+    integers, and values are the values times timeseries.SCALE, as little-endian
+    pairs of a 64 bit whole part and a 32 bit fraction, both base64 encoded. The
+    days are sorted.
+    """
+
+    current_value = models.ForeignKey(StockPropertyValue)
+    year = models.IntegerField()
+    days = models.TextField()
+    values = models.TextField()
+
+    class Meta:
+        unique_together = (('current_value', 'year'),)
+
+class SavedScreen(models.Model):
+    """
+    Saved screen holds the criterias, sector and exchange of a search, so it can
+    be run again, like by the backtest command.
+
+    criterias is a JSON list of [stock property id, min value, max value], the
+    values are strings (null for no min or max). See the backtest module.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    criterias = models.TextField()
+    sector = models.ForeignKey(Sector, null=True, blank=True)
+    exchange = models.CharField(max_length=10, choices=Company.EXCHANGES, blank=True)
+
+    def __str__(self):
+        return self.name
+
+class DataVersion(models.Model):
+    """
+    Data version is a counter that the importers increase when they have written
+    new values, so the caches of other processes know their data is old.
+    There is only one row (see the cache module).
+    """
+
+    version = models.IntegerField(default=0)
+
+class StockPropertyHistogram(models.Model):
+    """
+    Stock property histogram holds the distribution of the values of a stock
+    property, so the distribution graph does not count the values on every view.
+
+    counts is the number of values in each of the ranges between min_value and
+    max_value (comma separated), and quantiles are the values at the quantiles
+    in histogram.QUANTILES (comma separated). See the histogram module.
+    """
+
+    stock_property = models.ForeignKey(StockProperty, unique=True)
+    min_value = models.DecimalField(max_digits=19, decimal_places=5)
+    max_value = models.DecimalField(max_digits=19, decimal_places=5)
+    counts = models.TextField()
+    quantiles = models.TextField()
+
+    def get_counts(self):
+        return [ int(c) for c in self.counts.split(',') ]
+
+    def set_counts(self, counts):
+        self.counts = ','.join([ str(c) for c in counts ])
+
+    def get_quantiles(self):
+        return [ Decimal(q) for q in self.quantiles.split(',') ]
+
+    def set_quantiles(self, quantiles):
+        self.quantiles = ','.join([ str(q) for q in quantiles ])
+
+class StockPropertyStats(models.Model):
+    """
+    Stock property stats holds the statistics of the values of a stock property:
+    the number of values, min, max, and the sum of the values and of their squares
+    (for the mean and standard deviation). See the stats module.
+    """
+
+    stock_property = models.ForeignKey(StockProperty, unique=True)
+    count = models.IntegerField()
+    min_value = models.DecimalField(max_digits=19, decimal_places=5)
+    max_value = models.DecimalField(max_digits=19, decimal_places=5)
+    total = models.FloatField()
+    total_squares = models.FloatField()
+
+    def mean(self):
+        return self.total / self.count
+
+    def stddev(self):
+        variance = self.total_squares / self.count - self.mean() ** 2
+        # rounding can make the variance a tiny bit negative
+        return math.sqrt(max(variance, 0.0))
+
+    def quantiles(self):
+        """
+        The approximate quantiles (histogram.QUANTILES) from the histogram of the
+        stock property, None if there is no histogram.
+        """
+        try:
+            return StockPropertyHistogram.objects.get(stock_property__id=self.stock_property_id).get_quantiles()
+        except StockPropertyHistogram.DoesNotExist:
+            return None
@@ -1,27 +1,125 @@
 
+import base64, bisect, heapq
+from decimal import Decimal
+from django.conf import settings
+from django.db.models import signals
 from models import Company, StockPropertyValue, StockProperty
+from cache import DataVersionCache
+import snapshot, stats
 
 """
 This is the query to find the ID of the companies that are matching
 the criterias.
 
-Order by number gives the companies matching most criteria at the top.
+A company has one value per stock property, so the matching companies are the
+ones matching all the criterias (number is the number of criterias). They are
+ordered by id, and AFTER skips the companies up to the id of the last company on
+the previous page (keyset pagination, see query), so every page costs the same.
+
+When the results are sorted by a stock property (see PropertyOrder), SORT_JOIN
+joins the value to sort by as o.value, SORT_PAGE skips the companies on the
+previous pages, and SORT_BY is the order. Otherwise SORT_VALUE is null and the
+results are ordered by id.
+
+CRITERIA, SECTOR, EXCHANGE and AFTER are replaced by SQL with %s placeholders, and the
+values are passed as parameters. So the SQL only depends on the number of criterias
+and whether there is a sector and exchange, and the database can reuse its plan.
 """
 SEARCH_QUERY = """
-        select t1.id from (
+        select t1.id, SORT_VALUE from (
             select c.id as id, count(*) as number
               from search_company c left outer join
                    search_stockpropertyvalue v on c.id = v.symbol_id
-                   left outer join search_stockproperty p on p.id = v.stock_property_id
              where ( CRITERIA )
                SECTOR
                EXCHANGE
+               AFTER
              group by c.id
-        ) t1
-        where number >= CRITERIA_COUNT
-        order by number
-        limit 25
+        ) t1 SORT_JOIN
+        where number >= %s
+          SORT_PAGE
+        order by SORT_BY
+        limit %s
+"""
+
+"""
+These are the queries for the 'intersect' search strategy, which finds the
+companies matching each criteria on its own (starting with the criteria matching
+the fewest companies), and intersects the sets of company ids. The number of
+companies a criteria matches is guessed from the statistics of the stock
+property (see the stats module).
+"""
+CRITERIA_QUERY = """
+        select v.symbol_id
+          from search_stockpropertyvalue v join
+               search_company c on c.id = v.symbol_id
+         where CRITERIA
+           SECTOR
+           EXCHANGE
+           AFTER
+           SYMBOLS
+"""
+
+COMPANY_QUERY = """
+        select c.id
+          from search_company c
+         where 1
+           SECTOR
+           EXCHANGE
+           AFTER
+         order by c.id
+         LIMIT
+"""
+
+"""
+These are the queries for sorting the candidates of the 'intersect' search
+strategy by a stock property. ORDER_VALUES_QUERY finds the values of the given
+companies (SYMBOLS), and ORDER_SCAN_QUERY walks through the values in the order
+of the results (using the stock property, value index), one chunk at a time.
 """
+ORDER_VALUES_QUERY = """
+        select v.symbol_id, v.value
+          from search_stockpropertyvalue v
+         where v.stock_property_id = %s
+           SYMBOLS
+"""
+
+ORDER_SCAN_QUERY = """
+        select v.symbol_id, v.value
+          from search_stockpropertyvalue v
+         where v.stock_property_id = %s
+           SORT_PAGE
+         order by SORT_BY
+         limit %s
+"""
+
+# the number of companies to return from a search (one page)
+SEARCH_LIMIT = 25
+
+# when fewer companies than this are left in the 'intersect' search strategy,
+# the next criteria only looks at these companies (symbol_id in (...))
+INTERSECT_IN_LIMIT = 500
+
+# the number of values read at a time when walking through the values of the
+# stock property to sort by, see order_ids
+ORDER_SCAN_CHUNK = 200
+
+# the number of companies loaded at a time by iter_results
+EXPORT_BATCH = 500
+
+# the search strategies, see query
+STRATEGIES = ('union', 'intersect', 'memory')
+
+# the directions to sort the results in, see PropertyOrder
+DIRECTIONS = ('asc', 'desc')
+
+# the results of the latest searches, see query
+result_cache = DataVersionCache(getattr(settings, 'SEARCH_CACHE_SIZE', 100))
+
+# the smallest and largest value that fits in StockPropertyValue.value
+# (19 digits, 5 decimals), used when a criteria has no min or max.
+MIN_VALUE = Decimal('-99999999999999.99999')
+MAX_VALUE = Decimal('99999999999999.99999')
 
 class Result(object):
     """
@@ -35,13 +133,22 @@ class Result(object):
         self.symbol = symbol
         self.values = values
 
+class ResultList(list):
+    """
+    Result list is the list of Result objects on one page of a search.
+    next_cursor is the cursor to give to query to get the next page, it is
+    None on the last page.
+    """
+    next_cursor = None
+
 class MinMaxCriteria(object):
     """
     Min max criteria is a helper class that handles the min and max values from the
     form for one criteria (stock property).
 
     The most important, it has a to_sql method, which converts into SQL that is
-    placed (together with other criterias) in the SEARCH_QUERY instead of "CRITERIA".
+    placed (together with other criterias) in the SEARCH_QUERY instead of "CRITERIA",
+    and a to_params method with the values for the placeholders in the SQL.
     """
 
     stock_property_id = None
@@ -56,51 +163,345 @@ class MinMaxCriteria(object):
     def __repr__(self):
         return "<id=%d min=%s max=%s>" % (self.stock_property_id, str(self.min_value), str(self.max_value))
 
-    def __has_value(self, value, operator):
+    def to_sql(self, qn_func):
+        """
+        Convert the min/max criteria to SQL criteria. The SQL is the same for all
+        criterias, a missing min or max is given as MIN_VALUE or MAX_VALUE.
+        """
+        return "( v.stock_property_id = %s and v.value between %s and %s )"
+
+    def to_params(self):
+        """
+        The parameters for the SQL from to_sql.
+        """
+        min_value, max_value = self.min_value, self.max_value
+        if min_value is None:
+            min_value = MIN_VALUE
+        if max_value is None:
+            max_value = MAX_VALUE
+        return [self.stock_property_id, min_value, max_value]
+
+class PropertyOrder(object):
+    """
+    Property order sorts the search results by the value of one stock property,
+    lowest first ('asc') or highest first ('desc'). The companies without a value
+    come last, and companies with the same value are ordered by id.
+
+    A company in the results has a key (company id, value), and the pages are
+    split after the key of the last company on the page (see after_sql).
+    """
+
+    stock_property_id = None
+    direction = 'asc'
+
+    def __init__(self, stock_property_id, direction='asc'):
+        if direction not in DIRECTIONS:
+            raise ValueError("Unknown direction: %s" % direction)
+        self.stock_property_id = stock_property_id
+        self.direction = direction
+
+    def __repr__(self):
+        return "<id=%d %s>" % (self.stock_property_id, self.direction)
+
+    def sort_key(self, key):
+        """
+        Convert a (company id, value) key to a tuple, which sorts in the order of
+        the results.
+        """
+        id, value = key
         if value is None:
-            return ""
+            return (1, 0, id)
+        elif self.direction == 'desc':
+            return (0, -value, id)
         else:
-            return " and v.value %s %s" % (operator, str(value))
+            return (0, value, id)
 
-    def to_sql(self, qn_func):
+    def to_sql(self, value_column, id_column):
+        """
+        The SQL to order by (SORT_BY), nulls (no value) last.
         """
-        Convert the min/max criteria to SQL criteria.
+        return "case when %s is null then 1 else 0 end, %s %s, %s" % (
+            value_column, value_column, self.direction, id_column)
+
+    def after_sql(self, value_column, id_column, after):
+        """
+        Handles skipping the companies up to the key after (SORT_PAGE), returns
+        the SQL and the parameters.
         """
-        if self.min_value is None and self.max_value is None:
-            return "( p.id = %d )" % (self.stock_property_id)
+        if after is None:
+            return "", []
+
+        id, value = after
+        if value is None:
+            return " and %s is null and %s > %%s" % (value_column, id_column), [id]
+
+        if self.direction == 'desc':
+            op = '<'
         else:
-            return "( p.id = %d%s%s )" % \
-                (self.stock_property_id,
-                 self.__has_value(self.min_value, '>='),
-                 self.__has_value(self.max_value, '<='))
+            op = '>'
+        sql = " and ( %s %s %%s or ( %s = %%s and %s > %%s ) or %s is null )" % (
+            value_column, op, value_column, id_column, value_column)
+        return sql, [value, value, id]
 
 def build_sector_criteria(qn, sector):
     """
-    Handles creating sector criteria (SECTOR)
+    Handles creating sector criteria (SECTOR), returns the SQL and the parameters.
     """
     if sector is None or sector.strip() == '':
-        return ""
+        return "", []
     else:
-        return " and c.sector_id = %s " % sector
+        return " and c.sector_id = %s ", [int(sector)]
 
 def build_exchange_criteria(qn, exchange):
     """
-    Handles creating exchange criteria (EXCHANGE)
+    Handles creating exchange criteria (EXCHANGE), returns the SQL and the parameters.
     """
     if exchange is None or exchange.strip() == '':
-        return ""
+        return "", []
+    else:
+        return " and c.exchange = %s", [exchange]
+
+def build_after_criteria(qn, after):
+    """
+    Handles skipping the companies on the previous pages (AFTER), returns the SQL
+    and the parameters.
+    """
+    if after is None:
+        return "", []
     else:
-        return " and c.exchange = '%s'" % exchange
+        return " and c.id > %s", [after]
+
+def encode_cursor(key, order=None):
+    """
+    Encode the cursor of the next page, after the company with the given
+    (company id, value) key. The value is only kept when sorting by a stock property.
+    """
+    id, value = key
+    if order is None:
+        return base64.urlsafe_b64encode(str(id))
+    if value is None:
+        value = ''
+    return base64.urlsafe_b64encode("%d:%s" % (id, value))
 
-def query(criterias, sector=None, exchange=None, show='all'):
+def decode_cursor(cursor, order=None):
+    """
+    Decode the cursor from encode_cursor, returns the (company id, value) key.
+    Raises a ValueError if the cursor is not valid.
+    """
+    try:
+        s = base64.urlsafe_b64decode(str(cursor))
+        if order is None:
+            return int(s), None
+        id, value = s.split(':')
+        if value == '':
+            return int(id), None
+        return int(id), Decimal(value)
+    except (TypeError, ValueError, ArithmeticError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+def query(criterias, sector=None, exchange=None, show='all', strategy=None,
+          cursor=None, limit=SEARCH_LIMIT, order=None, asof=None):
     """
     Query performs the actual query to the database. It builds SQL that 
     represents the query of the user with min/max criterias, sector, and exchange limitations.
 
+    The strategy decides how the matching companies are found:
+
+    'union' - one SEARCH_QUERY that counts the criterias matched by each company.
+    'intersect' - one query per criteria, the most selective first, and the
+                  company ids are intersected (see query_ids_intersect).
+    'memory' - in the in-memory snapshot (see the snapshot module).
+
+    If no strategy is given, it is 'memory' if settings.USE_MEMORY_SEARCH is set,
+    otherwise settings.SEARCH_STRATEGY.
+
     If there are any matching companies, then it filters which attributes to show ('all' or
     'criteria')
 
     Finally it returns the results as a list of Result objects.
+
+    The results are returned in pages of limit companies, ordered by company id,
+    or by the value of a stock property if order (a PropertyOrder) is given. Only
+    the companies on the page are found in the database (or snapshot), the results
+    are not sorted afterwards.
+
+    The ResultList has the cursor of the next page in next_cursor, and the next
+    page is returned when giving this cursor to query with the same criterias
+    and order.
+
+    If asof (a date) is given, the search is done on the values as of that date
+    instead of the current values: the newest historical value at or before the
+    date of each company and stock property. They are found once per date and
+    kept in a snapshot (see snapshot.get_snapshot_asof), so the strategy is
+    always 'memory', and the values in the results are the values as of the date.
+
+    The results are kept in the result_cache, until the importers change the data
+    version, or a company, stock property or value is saved in this process.
+    """
+
+    after = None
+    if cursor is not None and cursor != '':
+        after = decode_cursor(cursor, order)
+
+    result_cache.check_version()
+    key = cache_key(criterias, sector, exchange, show, order, asof) + (after, limit)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # the keys of the matching companies, in the order of the results. One more
+    # than the limit, to know if there is a next page
+    keys = find_keys(criterias, sector, exchange, strategy, after, limit + 1, order, asof)
+    ids = [ id for id, value in keys ]
+
+    headers = find_headers(criterias, show)
+
+    results = ResultList(build_results(ids[:limit], headers, asof))
+    if len(ids) > limit:
+        results.next_cursor = encode_cursor(keys[limit - 1], order)
+
+    result = headers, results
+    result_cache.put(key, result)
+    return result
+
+def find_headers(criterias, show='all'):
+    """
+    Returns the stock properties to show in the results ('all' or 'criteria').
+    """
+    if show == 'all':
+        # show all properties
+        return list(StockProperty.objects.all())
+    else:
+        # show criterias as properties, keep the order of the criterias
+        properties = StockProperty.objects.in_bulk([ c.stock_property_id for c in criterias ])
+        return [ properties[c.stock_property_id] for c in criterias ]
+
+def iter_results(criterias, headers, sector=None, exchange=None, strategy=None,
+                 order=None, batch=EXPORT_BATCH, asof=None):
+    """
+    Iterate over all the results of a search (not one page) as Result objects,
+    with the values of the headers (see find_headers).
+
+    The results are found and loaded batch companies at a time, each batch
+    starting after the last company of the previous batch (like the pages of
+    query), so only one batch is in memory no matter how many companies match.
+    The results are not cached. asof is the date to search the values as of (see query).
+    """
+    after = None
+    while True:
+        keys = find_keys(criterias, sector, exchange, strategy, after, batch, order, asof)
+        for result in build_results([ id for id, value in keys ], headers, asof):
+            yield result
+        if len(keys) < batch:
+            break
+        after = keys[-1]
+
+def cache_key(criterias, sector, exchange, show, order=None, asof=None):
+    """
+    The key of a search in the result_cache. The criterias are sorted and the
+    min/max values normalized, so the same search always has the same key. For
+    show='criteria' the order of the criterias is kept, it is the order of the headers.
+    """
+    def normalize(value):
+        if value is None:
+            return None
+        return Decimal(value).normalize()
+
+    key = [ (c.stock_property_id, normalize(c.min_value), normalize(c.max_value)) for c in criterias ]
+    if show == 'all':
+        key.sort()
+
+    if sector is not None and sector.strip() == '':
+        sector = None
+    if exchange is not None and exchange.strip() == '':
+        exchange = None
+
+    if order is not None:
+        order = (order.stock_property_id, order.direction)
+
+    return (tuple(key), sector, exchange, show, order, asof)
+
+def clear_result_cache(sender, **kwargs):
+    """
+    Clear the result cache when the data is changed in this process.
+    """
+    result_cache.clear()
+
+for model in (Company, StockProperty, StockPropertyValue):
+    signals.post_save.connect(clear_result_cache, sender=model)
+    signals.post_delete.connect(clear_result_cache, sender=model)
+
+def find_ids(criterias, sector=None, exchange=None, strategy=None, after=None, limit=SEARCH_LIMIT, order=None, asof=None):
+    """
+    Find the ids of the companies matching the criterias, see find_keys.
+    """
+    return [ id for id, value in find_keys(criterias, sector, exchange, strategy, after, limit, order, asof) ]
+
+def find_keys(criterias, sector=None, exchange=None, strategy=None, after=None, limit=SEARCH_LIMIT, order=None, asof=None):
+    """
+    Find the companies matching the criterias with the given search strategy
+    (see query). Returns at most limit (company id, value) keys in the order of
+    the results, after the key after.
+
+    Without an order the keys are sorted by id, and the value is None.
+
+    With asof, the companies are found in the snapshot of the values as of
+    that date, whatever the strategy.
+    """
+    if asof is not None:
+        return match_snapshot(criterias, sector, exchange, after, limit, order, asof)
+
+    if strategy is None:
+        strategy = default_strategy()
+
+    if strategy == 'memory':
+        return match_snapshot(criterias, sector, exchange, after, limit, order)
+    elif strategy == 'intersect':
+        return query_ids_intersect(criterias, sector, exchange, after, limit, order)
+    elif strategy == 'union':
+        return query_ids(criterias, sector, exchange, after, limit, order)
+    else:
+        raise ValueError("Unknown search strategy: %s" % strategy)
+
+def default_strategy():
+    """
+    The search strategy to use when query is not given one.
+    """
+    if getattr(settings, 'USE_MEMORY_SEARCH', False):
+        return 'memory'
+    return getattr(settings, 'SEARCH_STRATEGY', 'union')
+
+def match_snapshot(criterias, sector=None, exchange=None, after=None, limit=SEARCH_LIMIT, order=None, asof=None):
+    """
+    Find the keys of the companies matching the criterias in the in-memory snapshot
+    (of the values as of the date asof, if given).
+    """
+    if asof is None:
+        s = snapshot.get_snapshot()
+    else:
+        s = snapshot.get_snapshot_asof(asof)
+    if order is None:
+        if after is not None:
+            after = after[0]
+        return [ (id, None) for id in s.match(criterias, sector, exchange, after, limit) ]
+
+    keys = [ (id, s.get_decimal(id, order.stock_property_id)) for id in s.match(criterias, sector, exchange) ]
+    return top_keys(keys, order, after, limit)
+
+def top_keys(keys, order, after=None, limit=SEARCH_LIMIT):
+    """
+    Returns the first limit keys after the key after, in the given order. Only
+    the limit first keys are kept while looking through the keys (no full sort).
+    """
+    if after is not None:
+        after_key = order.sort_key(after)
+        keys = [ k for k in keys if order.sort_key(k) > after_key ]
+    return heapq.nsmallest(limit, keys, key=order.sort_key)
+
+def query_ids(criterias, sector=None, exchange=None, after=None, limit=SEARCH_LIMIT, order=None):
+    """
+    Find the keys of the companies matching the criterias using the SEARCH_QUERY
+    in the database.
     """
 
     # get database connection
@@ -109,46 +510,216 @@ def query(criterias, sector=None, exchange=None, show='all'):
     qn = connection.ops.quote_name
 
     # build criteria
+    params = []
     if len(criterias) == 0:
         sql_criteria = '1'
     else:
         sql_criteria = ' or '.join([ c.to_sql(qn) for c in criterias ])
+        for c in criterias:
+            params.extend(c.to_params())
 
-    sql = SEARCH_QUERY.replace('CRITERIA_COUNT', str(len(criterias))).replace('CRITERIA', sql_criteria)
-    sql = sql.replace('SECTOR', build_sector_criteria(qn, sector))
-    sql = sql.replace('EXCHANGE', build_exchange_criteria(qn, exchange))
+    sql_sector, sector_params = build_sector_criteria(qn, sector)
+    sql_exchange, exchange_params = build_exchange_criteria(qn, exchange)
+    params.extend(sector_params)
+    params.extend(exchange_params)
 
-    print "SQL=", sql
+    if order is None:
+        sql_after, after_params = build_after_criteria(qn, after and after[0])
+        params.extend(after_params)
+        params.extend([len(criterias)])
+        sql_value, sql_join, sql_page, sql_order = 'null', '', '', 't1.id'
+    else:
+        sql_after = ''
+        sql_value = 'o.value'
+        sql_join = """left outer join
+             search_stockpropertyvalue o on o.symbol_id = t1.id and o.stock_property_id = %s"""
+        sql_page, page_params = order.after_sql('o.value', 't1.id', after)
+        sql_order = order.to_sql('o.value', 't1.id')
+        params.extend([order.stock_property_id, len(criterias)])
+        params.extend(page_params)
+    params.append(limit)
 
-    cursor.execute(sql)
+    sql = SEARCH_QUERY.replace('CRITERIA', sql_criteria)
+    sql = sql.replace('SECTOR', sql_sector)
+    sql = sql.replace('EXCHANGE', sql_exchange)
+    sql = sql.replace('AFTER', sql_after)
+    sql = sql.replace('SORT_VALUE', sql_value).replace('SORT_JOIN', sql_join)
+    sql = sql.replace('SORT_PAGE', sql_page).replace('SORT_BY', sql_order)
 
-    # get the headers to show
-    if show == 'all':
-        # show all properties
-        headers = StockProperty.objects.all()
+    cursor.execute(sql, params)
+
+    return [ (row[0], row[1]) for row in cursor.fetchall() ]
+
+def query_ids_intersect(criterias, sector=None, exchange=None, after=None, limit=SEARCH_LIMIT, order=None):
+    """
+    Find the keys of the companies matching the criterias, one criteria at a time.
+
+    The criterias are sorted by how many companies they are expected to match,
+    and the first criteria (with the sector and exchange) gives the candidates.
+    The candidates are intersected with the companies matching the next criteria,
+    and when only a few candidates are left, the next criteria only looks at those.
+
+    When sorting by a stock property, the page is found among all the candidates
+    by order_ids.
+    """
+    from django.db import connection
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+
+    sql_sector, sector_params = build_sector_criteria(qn, sector)
+    sql_exchange, exchange_params = build_exchange_criteria(qn, exchange)
+    if order is None:
+        sql_after, after_params = build_after_criteria(qn, after and after[0])
     else:
-        # show criterias as properties
-        headers = [ StockProperty.objects.get(id=c.stock_property_id) for c in criterias ]
-    
+        sql_after, after_params = "", []
+    company_params = sector_params + exchange_params + after_params
+
+    if len(criterias) == 0:
+        sql = COMPANY_QUERY.replace('SECTOR', sql_sector).replace('EXCHANGE', sql_exchange)
+        sql = sql.replace('AFTER', sql_after)
+        if order is None:
+            cursor.execute(sql.replace('LIMIT', 'limit %s'), company_params + [limit])
+            return [ (row[0], None) for row in cursor.fetchall() ]
+        cursor.execute(sql.replace('LIMIT', ''), company_params)
+        return order_ids(set([ row[0] for row in cursor.fetchall() ]), order, after, limit)
+
+    ids = None
+    for c in order_by_selectivity(criterias):
+        sql = CRITERIA_QUERY.replace('CRITERIA', c.to_sql(qn))
+        params = c.to_params()
+
+        if ids is None:
+            # the first criteria also checks the sector, exchange and page
+            sql = sql.replace('SECTOR', sql_sector).replace('EXCHANGE', sql_exchange)
+            sql = sql.replace('AFTER', sql_after)
+            params.extend(company_params)
+        else:
+            sql = sql.replace('SECTOR', '').replace('EXCHANGE', '').replace('AFTER', '')
+
+        if ids is not None and len(ids) <= INTERSECT_IN_LIMIT:
+            sql = sql.replace('SYMBOLS', " and v.symbol_id in (%s)" % ', '.join(['%s'] * len(ids)))
+            params.extend(ids)
+        else:
+            sql = sql.replace('SYMBOLS', '')
+
+        cursor.execute(sql, params)
+        found = set([ row[0] for row in cursor.fetchall() ])
+
+        if ids is None:
+            ids = found
+        else:
+            ids = ids & found
+
+        if len(ids) == 0:
+            return []
+
+    if order is not None:
+        return order_ids(ids, order, after, limit)
+
+    return [ (id, None) for id in sorted(ids)[:limit] ]
+
+def order_ids(ids, order, after=None, limit=SEARCH_LIMIT):
+    """
+    Sort the set of candidate company ids by the stock property of the order, and
+    returns the first limit (company id, value) keys after the key after.
+
+    For a few candidates, their values are loaded and the first keys are found in
+    memory. Otherwise the values of the stock property are read in the order of the
+    results, one chunk at a time, until the page is full of candidates, so a page
+    near the top does not load all the values.
+    """
+    if len(ids) == 0:
+        return []
+
+    from django.db import connection
+    cursor = connection.cursor()
+
+    if len(ids) <= INTERSECT_IN_LIMIT:
+        sql = ORDER_VALUES_QUERY.replace('SYMBOLS', " and v.symbol_id in (%s)" % ', '.join(['%s'] * len(ids)))
+        cursor.execute(sql, [order.stock_property_id] + list(ids))
+        values = dict(cursor.fetchall())
+        return top_keys([ (id, values.get(id)) for id in ids ], order, after, limit)
+
+    keys = []
+    page = after
+    if after is None or after[1] is not None:
+        sql_order = order.to_sql('v.value', 'v.symbol_id')
+        while True:
+            sql_page, page_params = order.after_sql('v.value', 'v.symbol_id', page)
+            sql = ORDER_SCAN_QUERY.replace('SORT_PAGE', sql_page).replace('SORT_BY', sql_order)
+            cursor.execute(sql, [order.stock_property_id] + page_params + [ORDER_SCAN_CHUNK])
+            rows = cursor.fetchall()
+            for id, value in rows:
+                if id in ids:
+                    keys.append((id, value))
+                    if len(keys) >= limit:
+                        return keys
+            if len(rows) < ORDER_SCAN_CHUNK:
+                break
+            page = rows[-1]
+
+    # the rest of the page are the candidates without a value, ordered by id
+    sql = ORDER_VALUES_QUERY.replace('SYMBOLS', '')
+    cursor.execute(sql, [order.stock_property_id])
+    with_value = set([ row[0] for row in cursor.fetchall() ])
+    missing = sorted([ id for id in ids if id not in with_value ])
+    if after is not None and after[1] is None:
+        missing = missing[bisect.bisect_right(missing, after[0]):]
+    keys.extend([ (id, None) for id in missing[:limit - len(keys)] ])
+    return keys
+
+def order_by_selectivity(criterias):
+    """
+    Sort the criterias so the criteria expected to match the fewest companies
+    is first. The guess assumes the values of a stock property are spread evenly
+    between its min and max.
+    """
+    property_stats = stats.load_stats([ c.stock_property_id for c in criterias ])
+
+    def expected(c):
+        if not property_stats.has_key(c.stock_property_id):
+            # no values, it matches nothing
+            return 0.0
+        s = property_stats[c.stock_property_id]
+        count, min_value, max_value = [ float(v) for v in (s.count, s.min_value, s.max_value) ]
+        low, high = [ float(v) for v in c.to_params()[1:] ]
+        low, high = max(low, min_value), min(high, max_value)
+        if low > high:
+            return 0.0
+        if max_value == min_value:
+            return count
+        return count * (high - low) / (max_value - min_value)
+
+    return sorted(criterias, key=expected)
+
+def build_results(ids, headers, asof=None):
+    """
+    Builds the list of Result objects for the given company ids, with the values
+    of the header properties.
+
+    Uses one query for the companies and one query for the values (no matter how
+    many companies or headers), and pivots the values into a row per company.
+    With asof, the values are the values as of that date, from its snapshot.
+    """
+    if len(ids) == 0:
+        return []
+
+    symbols = Company.objects.in_bulk(ids)
+
+    if asof is not None:
+        s = snapshot.get_snapshot_asof(asof)
+        return [ Result(symbols[id], [ s.get_decimal(id, h.id) for h in headers ]) for id in ids ]
+
+    # load the values for all the companies at once: {company id: {property id: value}}
+    vmap = {}
+    for symbol_id, stock_property_id, value in StockPropertyValue.objects.filter(
+            symbol__in=ids, stock_property__in=[ h.id for h in headers ]).values_list(
+            'symbol', 'stock_property', 'value'):
+        vmap.setdefault(symbol_id, {})[stock_property_id] = value
+
     result_list = []
-    for row in cursor.fetchall():
-        symbol = Company.objects.get(id=row[0])
-        vlist = StockPropertyValue.objects.filter(symbol=symbol)
-        vmap = {}
-        for value in vlist:
-            vmap[value.stock_property_id] = value.value
-
-        values = []
-        for header in headers:
-            if vmap.has_key(header.id):
-                values.append(vmap[header.id])
-            else:
-                values.append(None)
-
-        # print "values=", values
-            
-        result_list.append(Result(symbol, values))
-
-    return headers, result_list
-
-    
+    for id in ids:
+        values = vmap.get(id, {})
+        result_list.append(Result(symbols[id], [ values.get(h.id) for h in headers ]))
+
+    return result_list
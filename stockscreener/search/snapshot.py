@@ -0,0 +1,288 @@
+import threading, bisect
+from array import array
+from decimal import Decimal
+from django.db.models import signals
+from models import Company, StockPropertyValue, StockPropertyValueHistory, StockPropertySeries
+from cache import get_data_version, DataVersionCache
+import timeseries
+
+"""
+The snapshot module holds an in-memory copy of the stock property values,
+so searches can be answered without asking the database.
+
+The values are stored by column: one dense array of floats per stock property,
+indexed by the company id, where a missing value is NaN.
+
+A snapshot can also hold the values as of a date in the past (from the history,
+see get_snapshot_asof), for screening as of that date.
+
+The snapshot of this process is loaded again when the importers change the data
+version. Changes made through the models in this process (the admin, the
+extractor) are applied by the post_save and post_delete signals.
+"""
+
+# the number of snapshots of past dates kept, see get_snapshot_asof
+ASOF_SNAPSHOTS = 4
+
+NAN = float('nan')
+INFINITY = float('inf')
+
+class ColumnarSnapshot(object):
+    """
+    Columnar snapshot holds all the stock property values in memory, and can
+    find the companies matching a list of MinMaxCriteria.
+
+    columns maps a stock property id to an array (indexed by company id) of the
+    values, and companies maps a company id to its (sector id, exchange).
+    decimals maps (company id, stock property id) to the exact value, it is only
+    kept by the snapshots of past dates, where the floats are only used for
+    matching (see build).
+    """
+
+    columns = None
+    companies = None
+    decimals = None
+    size = 0
+
+    def __init__(self):
+        self.columns = {}
+        self.companies = {}
+        self.size = 0
+
+    def build(self, values=None, exact=False):
+        """
+        Load all companies and values from the database. values can be given as
+        a list of (company id, stock property id, value), otherwise the current
+        StockPropertyValues are loaded. If exact is set, the decimals are kept.
+        """
+        self.columns = {}
+        self.companies = {}
+        self.decimals = None
+        self.size = 0
+
+        for id, sector_id, exchange in Company.objects.values_list('id', 'sector', 'exchange'):
+            self.set_company(id, sector_id, exchange)
+
+        if values is None:
+            values = StockPropertyValue.objects.values_list('symbol', 'stock_property', 'value')
+
+        for symbol_id, stock_property_id, value in values:
+            self.set_value(symbol_id, stock_property_id, value)
+
+        if exact:
+            self.decimals = dict([ ((symbol_id, stock_property_id), value)
+                                   for symbol_id, stock_property_id, value in values ])
+
+    def set_company(self, id, sector_id, exchange):
+        """
+        Add or update a company, grows the columns if the company id is new.
+        """
+        self.companies[id] = (sector_id, exchange)
+        if id >= self.size:
+            grow = id + 1 - self.size
+            for column in self.columns.values():
+                column.extend([NAN] * grow)
+            self.size = id + 1
+
+    def set_value(self, symbol_id, stock_property_id, value):
+        """
+        Set the value of one stock property for one company (None removes it)
+        """
+        if symbol_id >= self.size:
+            # company is not known yet, the sector/exchange is not known either.
+            self.set_company(symbol_id, None, None)
+
+        column = self.columns.get(stock_property_id)
+        if column is None:
+            column = array('d', [NAN]) * self.size
+            self.columns[stock_property_id] = column
+
+        if value is None:
+            column[symbol_id] = NAN
+        else:
+            column[symbol_id] = float(value)
+
+    def get_value(self, symbol_id, stock_property_id):
+        """
+        Get the value of one stock property for one company, None if missing.
+        """
+        column = self.columns.get(stock_property_id)
+        if column is None or symbol_id >= self.size:
+            return None
+        value = column[symbol_id]
+        if value != value:
+            return None
+        return value
+
+    def get_decimal(self, symbol_id, stock_property_id):
+        """
+        Get the value of one stock property for one company as a Decimal, None
+        if missing. It is the exact value if the snapshot keeps the decimals.
+        """
+        if self.decimals is not None:
+            return self.decimals.get((symbol_id, stock_property_id))
+        value = self.get_value(symbol_id, stock_property_id)
+        if value is None:
+            return None
+        return Decimal(repr(value))
+
+    def match(self, criterias, sector=None, exchange=None, after=None, limit=None, ids=None):
+        """
+        Find the ids of the companies matching all the criterias, the sector and
+        the exchange. The ids are returned sorted.
+
+        Only ids bigger than after are returned, and it stops when limit ids are
+        found, so a page costs the same no matter how deep it is. If ids is given,
+        only these companies are looked at.
+        """
+        if ids is None:
+            ids = sorted(self.companies.keys())
+        else:
+            ids = sorted([ id for id in ids if self.companies.has_key(id) ])
+        if after is not None:
+            ids = ids[bisect.bisect_right(ids, after):]
+
+        if sector is not None and sector.strip() != '':
+            sector = int(sector)
+        else:
+            sector = None
+
+        if exchange is not None and exchange.strip() == '':
+            exchange = None
+
+        ranges = []
+        for c in criterias:
+            column = self.columns.get(c.stock_property_id)
+            if column is None:
+                return []
+
+            # NaN (missing value) is never inside the range
+            low, high = -INFINITY, INFINITY
+            if c.min_value is not None:
+                low = float(c.min_value)
+            if c.max_value is not None:
+                high = float(c.max_value)
+            ranges.append((column, low, high))
+
+        found = []
+        for id in ids:
+            company_sector, company_exchange = self.companies[id]
+            if sector is not None and company_sector != sector:
+                continue
+            if exchange is not None and company_exchange != exchange:
+                continue
+            for column, low, high in ranges:
+                if not low <= column[id] <= high:
+                    break
+            else:
+                found.append(id)
+                if limit is not None and len(found) >= limit:
+                    break
+
+        return found
+
+#
+# The snapshot of this process, it is loaded the first time it is used, and
+# again when the importers have changed the data version.
+#
+_snapshot = None
+_snapshot_version = None
+_lock = threading.Lock()
+
+def get_snapshot():
+    """
+    Returns the snapshot of this process, loads it from the database if needed.
+    """
+    global _snapshot, _snapshot_version
+    _lock.acquire()
+    try:
+        version = get_data_version()
+        if _snapshot is None or version != _snapshot_version:
+            snapshot = ColumnarSnapshot()
+            snapshot.build()
+            _snapshot = snapshot
+            _snapshot_version = version
+        return _snapshot
+    finally:
+        _lock.release()
+
+# the snapshots of past dates, by date
+_asof_snapshots = DataVersionCache(ASOF_SNAPSHOTS)
+
+def get_snapshot_asof(date):
+    """
+    Returns a snapshot of the values as of the date (the newest historical value
+    at or before the date, see timeseries.values_asof). The latest snapshots are
+    kept, until the importers have changed the data version.
+    """
+    _asof_snapshots.check_version()
+    snapshot = _asof_snapshots.get(date)
+    if snapshot is None:
+        snapshot = ColumnarSnapshot()
+        snapshot.build(timeseries.values_asof(date), exact=True)
+        _asof_snapshots.put(date, snapshot)
+    return snapshot
+
+def invalidate():
+    """
+    Drop the snapshot, so it is loaded again on the next search.
+    """
+    global _snapshot
+    _lock.acquire()
+    try:
+        _snapshot = None
+    finally:
+        _lock.release()
+
+def value_saved(sp_value):
+    """
+    Patch the snapshot after a StockPropertyValue is saved (if the snapshot is loaded)
+    """
+    snapshot = _snapshot
+    if snapshot is not None:
+        snapshot.set_value(sp_value.symbol_id, sp_value.stock_property_id, sp_value.value)
+
+def value_deleted(sp_value):
+    """
+    Remove the value of a deleted StockPropertyValue from the snapshot (if loaded)
+    """
+    snapshot = _snapshot
+    if snapshot is not None:
+        snapshot.set_value(sp_value.symbol_id, sp_value.stock_property_id, None)
+
+def company_saved(company):
+    """
+    Patch the sector and exchange of a saved Company in the snapshot (if loaded)
+    """
+    snapshot = _snapshot
+    if snapshot is not None:
+        snapshot.set_company(company.id, company.sector_id, company.exchange)
+
+#
+# Keep the snapshots up to date when the data is changed in this process. The
+# snapshots of past dates are dropped, they are cheap to load again.
+#
+def patch_value(sender, instance, **kwargs):
+    value_saved(instance)
+
+def remove_value(sender, instance, **kwargs):
+    value_deleted(instance)
+
+def patch_company(sender, instance, **kwargs):
+    company_saved(instance)
+    _asof_snapshots.clear()
+
+def remove_company(sender, instance, **kwargs):
+    invalidate()
+    _asof_snapshots.clear()
+
+def clear_asof_snapshots(sender, **kwargs):
+    _asof_snapshots.clear()
+
+signals.post_save.connect(patch_value, sender=StockPropertyValue)
+signals.post_delete.connect(remove_value, sender=StockPropertyValue)
+signals.post_save.connect(patch_company, sender=Company)
+signals.post_delete.connect(remove_company, sender=Company)
+for model in (StockPropertyValueHistory, StockPropertySeries):
+    signals.post_save.connect(clear_asof_snapshots, sender=model)
+    signals.post_delete.connect(clear_asof_snapshots, sender=model)
@@ -0,0 +1,3 @@
+-- Index for the search: filters on the stock property and a range of the
+-- value, and joins on the company. Covers the whole query (no table lookups).
+CREATE INDEX search_stockpropertyvalue_search ON search_stockpropertyvalue (stock_property_id, value, symbol_id);
@@ -0,0 +1,4 @@
+-- Index for finding the newest historical value of a stock property value.
+CREATE INDEX search_stockpropertyvaluehistory_date ON search_stockpropertyvaluehistory (current_value_id, historical_date);
+-- Index for reading the history of all the values in a range of dates (backtest).
+CREATE INDEX search_stockpropertyvaluehistory_day ON search_stockpropertyvaluehistory (historical_date);
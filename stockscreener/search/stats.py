@@ -0,0 +1,132 @@
+from decimal import Decimal
+from models import StockPropertyStats
+
+"""
+The stats module keeps the statistics of the values of each stock property
+(count, min, max, mean and standard deviation) in the database, in the
+StockPropertyStats table, so the search form and the search planner do not
+look at the values to find them.
+
+The importers build the statistics of all the stock properties after importing
+(update_stats), and when the extractor changes a single value, the statistics
+are updated from the old and the new value (value_changed).
+"""
+
+"""
+STATS_QUERY finds the statistics of the stock properties in PROPERTIES (or of
+all the stock properties, when PROPERTIES is replaced by nothing), in one query.
+"""
+STATS_QUERY = """
+        select v.stock_property_id, count(*), min(v.value), max(v.value),
+               sum(v.value), sum(v.value * v.value)
+          from search_stockpropertyvalue v
+         where 1 PROPERTIES
+         group by v.stock_property_id
+"""
+
+def to_decimal(value):
+    # the database may return the min/max as float (sqlite)
+    if value is None or isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+def build_stats(stock_property_ids=None):
+    """
+    Find the statistics of the stock properties (all if stock_property_ids is None)
+    in the database, and save them. Returns {stock property id: StockPropertyStats},
+    stock properties without values are not included (and their statistics are removed).
+    """
+    from django.db import connection
+    cursor = connection.cursor()
+
+    if stock_property_ids is None:
+        sql, params = STATS_QUERY.replace('PROPERTIES', ''), []
+        existing = StockPropertyStats.objects.all()
+    else:
+        stock_property_ids = [ int(id) for id in stock_property_ids ]
+        if len(stock_property_ids) == 0:
+            return {}
+        sql = STATS_QUERY.replace('PROPERTIES', ' and v.stock_property_id in (%s)' % ', '.join(['%s'] * len(stock_property_ids)))
+        params = stock_property_ids
+        existing = StockPropertyStats.objects.filter(stock_property__in=stock_property_ids)
+
+    old = dict([ (s.stock_property_id, s) for s in existing ])
+
+    found = {}
+    cursor.execute(sql, params)
+    for stock_property_id, count, min_value, max_value, total, total_squares in cursor.fetchall():
+        s = old.pop(stock_property_id, None)
+        if s is None:
+            s = StockPropertyStats(stock_property_id=stock_property_id)
+        s.count = count
+        s.min_value = to_decimal(min_value)
+        s.max_value = to_decimal(max_value)
+        s.total = float(total)
+        s.total_squares = float(total_squares)
+        s.save()
+        found[stock_property_id] = s
+
+    # the stock properties which have no values any more
+    for s in old.values():
+        s.delete()
+
+    return found
+
+def update_stats():
+    """
+    Build the statistics of all the stock properties, the importers call this
+    after importing.
+    """
+    build_stats()
+
+def load_stats(stock_property_ids):
+    """
+    Returns {stock property id: StockPropertyStats} of the stock properties. The
+    statistics missing in the table are found by the database (and saved).
+    """
+    stock_property_ids = [ int(id) for id in stock_property_ids ]
+    stats = dict([ (s.stock_property_id, s) for s in
+                   StockPropertyStats.objects.filter(stock_property__in=stock_property_ids) ])
+
+    missing = [ id for id in stock_property_ids if not stats.has_key(id) ]
+    if len(missing) > 0:
+        stats.update(build_stats(missing))
+    return stats
+
+def get_stats(stock_property_id):
+    """
+    Returns the StockPropertyStats of the stock property, None if it has no values.
+    """
+    return load_stats([stock_property_id]).get(int(stock_property_id))
+
+def value_changed(stock_property_id, old_value, new_value):
+    """
+    Update the statistics after a value of the stock property is changed from
+    old_value to new_value (old_value is None for a new value).
+
+    The count and sums are updated from the two values. When the old value was
+    the min or max, the new min or max is not known, so the statistics are found
+    by the database again.
+    """
+    if old_value == new_value:
+        return
+
+    try:
+        s = StockPropertyStats.objects.get(stock_property__id=stock_property_id)
+    except StockPropertyStats.DoesNotExist:
+        build_stats([stock_property_id])
+        return
+
+    if old_value is not None and (old_value == s.min_value and new_value > old_value or
+                                  old_value == s.max_value and new_value < old_value):
+        build_stats([stock_property_id])
+        return
+
+    if old_value is None:
+        s.count += 1
+        old_value = 0
+    s.total += float(new_value) - float(old_value)
+    s.total_squares += float(new_value) ** 2 - float(old_value) ** 2
+    s.min_value = min(s.min_value, new_value)
+    s.max_value = max(s.max_value, new_value)
+    s.save()
@@ -0,0 +1,287 @@
+import base64, bisect, datetime, struct
+from django.conf import settings
+from django.db import connection, transaction
+from models import StockPropertyValueHistory, StockPropertySeries
+from stats import to_decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+The timeseries module keeps the historical values of the stock property values,
+in one of two backends (settings.HISTORY_BACKEND):
+
+'table' is a StockPropertyValueHistory row for each historical value (the
+default).
+
+'series' packs the historical values of a stock property value in one
+StockPropertySeries row per year: the days and the values are arrays of
+integers, so a year of daily values is two short strings instead of 365 rows,
+and reading a range of dates only reads the years in the range. There is one
+value per day, a value added for a day which has a value replaces it.
+
+The importers add the historical values with add_history, and read_history
+and read_array read them from either backend. migrate_history copies the table
+to the series (see the migratehistory command). values_asof finds the values of
+all the companies at a date in the past, for screening as of that date, and
+changes_between the values changed in a range of dates (see the backtest module).
+"""
+
+# the values are kept as integers, value * SCALE (the values have 5 decimals).
+# value * SCALE does not fit in 64 bits for the biggest values (19 digits), so
+# it is packed as the whole units ('q') and the fraction ('I') of the value.
+SCALE = 100000
+VALUE_FORMAT = 'qI'
+
+INSERT_HISTORY_QUERY = """
+        insert into search_stockpropertyvaluehistory (current_value_id, historical_value, historical_date)
+        values (%s, %s, %s)
+"""
+
+HISTORY_QUERY = """
+        select h.current_value_id, h.historical_value, h.historical_date
+          from search_stockpropertyvaluehistory h
+         order by h.current_value_id, h.historical_date, h.id
+"""
+
+"""
+ASOF_QUERY finds the newest historical value at or before a date of every stock
+property value. The newest date of each value is found by a group by (the
+(current_value_id, historical_date) index answers it without reading the rows),
+and joined back to its row, so it is not a subquery per row. Rows with the same
+date are ordered by id, the last one is the newest.
+"""
+ASOF_QUERY = """
+        select v.symbol_id, v.stock_property_id, h.historical_value
+          from (select h2.current_value_id, max(h2.historical_date) as historical_date
+                  from search_stockpropertyvaluehistory h2
+                 where h2.historical_date <= %s
+                 group by h2.current_value_id) newest
+          join search_stockpropertyvaluehistory h on h.current_value_id = newest.current_value_id
+                                                 and h.historical_date = newest.historical_date
+          join search_stockpropertyvalue v on v.id = h.current_value_id
+         order by h.id
+"""
+
+"""
+CHANGES_QUERY finds the historical values of all the stock property values in a
+range of dates, using the historical_date index.
+"""
+CHANGES_QUERY = """
+        select h.historical_date, v.symbol_id, v.stock_property_id, h.historical_value
+          from search_stockpropertyvaluehistory h
+          join search_stockpropertyvalue v on v.id = h.current_value_id
+         where h.historical_date > %s
+           and h.historical_date <= %s
+         order by h.historical_date, h.id
+"""
+
+def history_backend():
+    return getattr(settings, 'HISTORY_BACKEND', 'table')
+
+def pack(format, numbers):
+    return base64.b64encode(struct.pack('<%d%s' % (len(numbers), format), *numbers))
+
+def unpack(format, text):
+    data = base64.b64decode(text)
+    return list(struct.unpack('<' + format * (len(data) / struct.calcsize('<' + format)), data))
+
+def pack_values(values):
+    """
+    Pack the values as (units, fraction) of value * SCALE, see VALUE_FORMAT.
+    """
+    numbers = []
+    for value in values:
+        numbers.extend(divmod(int(to_decimal(value) * SCALE), SCALE))
+    return base64.b64encode(struct.pack('<' + VALUE_FORMAT * len(values), *numbers))
+
+def unpack_values(text):
+    numbers = unpack(VALUE_FORMAT, text)
+    return [ to_decimal(units * SCALE + fraction) / SCALE
+             for units, fraction in zip(numbers[0::2], numbers[1::2]) ]
+
+def get_points(series):
+    """
+    Returns the [(date, value)] of the series, sorted by date.
+    """
+    start = datetime.date(series.year, 1, 1)
+    days = unpack('H', series.days)
+    values = unpack_values(series.values)
+    return [ (start + datetime.timedelta(days=day), value) for day, value in zip(days, values) ]
+
+def set_points(series, points):
+    """
+    Pack the [(date, value)] in the series, the dates must be in its year.
+    """
+    points = sorted(points)
+    start = datetime.date(series.year, 1, 1)
+    series.days = pack('H', [ (date - start).days for date, value in points ])
+    series.values = pack_values([ value for date, value in points ])
+
+def add_history(rows):
+    """
+    Add the historical values, rows is a list of (stock property value id,
+    value, date), to the history backend.
+    """
+    if len(rows) == 0:
+        return
+    if history_backend() == 'series':
+        add_series(rows)
+    else:
+        cursor = connection.cursor()
+        cursor.executemany(INSERT_HISTORY_QUERY, rows)
+        transaction.commit_unless_managed()
+
+def add_series(rows):
+    """
+    Add the historical values to the series, each series changed is read and
+    written once.
+    """
+    added = {}
+    for id, value, date in rows:
+        added.setdefault((id, date.year), {})[date] = value
+
+    ids = list(set([ id for id, year in added.keys() ]))
+    years = list(set([ year for id, year in added.keys() ]))
+    existing = dict([ ((s.current_value_id, s.year), s) for s in
+                      StockPropertySeries.objects.filter(current_value__in=ids, year__in=years) ])
+
+    for (id, year), values in added.items():
+        series = existing.get((id, year))
+        if series is None:
+            series = StockPropertySeries(current_value_id=id, year=year)
+            points = {}
+        else:
+            points = dict(get_points(series))
+        points.update(values)
+        set_points(series, points.items())
+        series.save()
+
+def read_history(current_value_id, start=None, end=None):
+    """
+    Returns the [(date, value)] of the stock property value between the start
+    and end dates (both included, None is no limit), sorted by date.
+    """
+    if history_backend() == 'series':
+        found = StockPropertySeries.objects.filter(current_value__id=current_value_id)
+        if start is not None:
+            found = found.filter(year__gte=start.year)
+        if end is not None:
+            found = found.filter(year__lte=end.year)
+        points = []
+        for series in found.order_by('year'):
+            points.extend(get_points(series))
+
+        # only the first and last year can have dates outside the range
+        dates = [ date for date, value in points ]
+        first, last = 0, len(points)
+        if start is not None:
+            first = bisect.bisect_left(dates, start)
+        if end is not None:
+            last = bisect.bisect_right(dates, end)
+        return points[first:last]
+
+    found = StockPropertyValueHistory.objects.filter(current_value__id=current_value_id)
+    if start is not None:
+        found = found.filter(historical_date__gte=start)
+    if end is not None:
+        found = found.filter(historical_date__lte=end)
+    return [ (date, value) for value, date in
+             found.order_by('historical_date', 'id').values_list('historical_value', 'historical_date') ]
+
+def values_asof(date):
+    """
+    Returns the values of all the companies at the date (the newest historical
+    value at or before the date) as a list of (company id, stock property id,
+    value). A value appears only once, a company without history at the date
+    has no value.
+    """
+    if history_backend() == 'series':
+        return series_asof(date)
+
+    cursor = connection.cursor()
+    cursor.execute(ASOF_QUERY, [date])
+
+    # the same date more than once, the last (highest id) wins
+    found = {}
+    for symbol_id, stock_property_id, value in cursor.fetchall():
+        found[(symbol_id, stock_property_id)] = to_decimal(value)
+    return [ (symbol_id, stock_property_id, value) for (symbol_id, stock_property_id), value in found.items() ]
+
+def series_asof(date):
+    """
+    values_asof for the series backend: the newest year at or before the date
+    of each value is read, and the date is found in it.
+    """
+    found = {}
+    for symbol_id, stock_property_id, year, days, values in StockPropertySeries.objects.filter(
+            year__lte=date.year).order_by('-year').values_list(
+            'current_value__symbol', 'current_value__stock_property', 'year', 'days', 'values'):
+        if found.has_key((symbol_id, stock_property_id)):
+            continue
+        points = get_points(StockPropertySeries(year=year, days=days, values=values))
+        i = bisect.bisect_right([ d for d, value in points ], date)
+        if i > 0:
+            found[(symbol_id, stock_property_id)] = points[i - 1][1]
+    return [ (symbol_id, stock_property_id, value) for (symbol_id, stock_property_id), value in found.items() ]
+
+def changes_between(start, end):
+    """
+    Returns the historical values of all the companies after the start date, up
+    to and including the end date, as a list of (date, company id, stock property
+    id, value) sorted by date. Applied in order to the values as of start (see
+    values_asof), they give the values as of any date in between.
+    """
+    if history_backend() == 'series':
+        changes = []
+        for symbol_id, stock_property_id, year, days, values in StockPropertySeries.objects.filter(
+                year__gte=start.year, year__lte=end.year).values_list(
+                'current_value__symbol', 'current_value__stock_property', 'year', 'days', 'values'):
+            for date, value in get_points(StockPropertySeries(year=year, days=days, values=values)):
+                if start < date <= end:
+                    changes.append((date, symbol_id, stock_property_id, value))
+        changes.sort()
+        return changes
+
+    cursor = connection.cursor()
+    cursor.execute(CHANGES_QUERY, [start, end])
+    return [ (date, symbol_id, stock_property_id, to_decimal(value))
+             for date, symbol_id, stock_property_id, value in cursor.fetchall() ]
+
+def read_array(current_value_id, start=None, end=None):
+    """
+    Returns the history of the stock property value (see read_history) as two
+    NumPy arrays: the dates (datetime64[D]) and the values (float64). NumPy is
+    not needed by the rest of the screener, so it is only imported here.
+    """
+    if numpy is None:
+        raise ImportError('read_array needs NumPy')
+    points = read_history(current_value_id, start, end)
+    dates = numpy.array([ date.isoformat() for date, value in points ], dtype='datetime64[D]')
+    values = numpy.array([ float(value) for date, value in points ], dtype='float64')
+    return dates, values
+
+def migrate_history(delete=False, batch=10000):
+    """
+    Copy the StockPropertyValueHistory table to the series, batch rows at a time
+    (a series can be written more than once, the values are merged). If delete
+    is set, the table is emptied afterwards. Returns the number of rows copied.
+    """
+    cursor = connection.cursor()
+    cursor.execute(HISTORY_QUERY)
+
+    copied = 0
+    while True:
+        rows = cursor.fetchmany(batch)
+        if len(rows) == 0:
+            break
+        add_series(rows)
+        copied += len(rows)
+
+    if delete:
+        cursor.execute("delete from search_stockpropertyvaluehistory")
+        transaction.commit_unless_managed()
+
+    return copied
@@ -1,30 +1,55 @@
 # Create your views here.
 
 from DistrGraph import GraphHelper
-from django.http import HttpResponseRedirect
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, HttpResponseRedirect
 from django.shortcuts import render_to_response
-import forms, search
-from models import StockProperty, StockPropertyValue
+import forms, search, export, histogram, stats, backtest
+from cache import DataVersionCache
+from models import StockProperty
+
+# the rendered distribution graphs, by (stock property id, data version)
+graph_cache = DataVersionCache(getattr(settings, 'GRAPH_CACHE_SIZE', 100))
 
 #
-# Build graph url, and send redirect to it.
+# Draw the graph, and send it as an SVG image.
 #
 def distrgraph(request, stock_property_id):
     """
-    Builds a graph URL using the GraphHelper, and sends HTTP Redirect to this
-    new URL.
+    Draws the distribution graph of a stock property as an SVG image using the
+    GraphHelper. The saved histogram of the stock property is used if there is
+    one (see the histogram module), otherwise the values are counted.
+
+    The graph only changes when the importers change the data version, so the
+    images are kept in the graph_cache, and the data version is the ETag of the
+    image: a browser asking again with the same ETag gets a 304 Not Modified.
 
-    If there was an exception creating the URL, we send HTTP Redirect to the graph-error
+    If there was an exception drawing the graph, we send HTTP Redirect to the graph-error
     image (so browser will show that)
     """
     try:
-        g = GraphHelper()
-    
-        data, y_min, y_max = g.create_data(50, None, stock_property_id)
+        graph_cache.check_version()
+        etag = '"%s-%s"' % (stock_property_id, graph_cache.version)
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+
+        key = (int(stock_property_id), graph_cache.version)
+        svg = graph_cache.get(key)
+        if svg is None:
+            g = GraphHelper()
 
-        url = g.create_graph_url(data, y_min, y_max, 220, 75)
+            data = histogram.get_data(stock_property_id)
+            if data is None:
+                data = g.create_data(histogram.HISTOGRAM_BUCKETS, None, stock_property_id)
+            data, y_min, y_max = data
 
-        return HttpResponseRedirect(url)
+            svg = g.create_graph_svg(data, y_min, y_max, 220, 75)
+            graph_cache.put(key, svg)
+
+        response = HttpResponse(svg, mimetype='image/svg+xml')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'max-age=%d' % getattr(settings, 'GRAPH_MAX_AGE', 3600)
+        return response
 
     except Exception, e:
         print e.message
@@ -51,17 +76,27 @@ def addcriteria(request, stock_property_id):
     A criteria is found, and we find min/max values, and returns the criteria.html
     in response, which contains input fields for the user to enter details about
     this criteria.
+
+    The min/max values (and quartiles) are taken from the statistics of the
+    stock property (see the stats module), so the values are not loaded. If the
+    criteria has no values, the min/max fields are empty.
     """
 
     # get the criteria
     criteria = StockProperty.objects.get(id=stock_property_id)
 
     # find the min/max for the criteria
-    values = StockPropertyValue.objects.filter(stock_property=criteria).values_list('value',flat=True)
-    min_value = min(values).normalize()
-    max_value = max(values).normalize()
+    min_value, max_value, quantiles = '', '', None
+    s = stats.get_stats(criteria.id)
+    if s is not None:
+        min_value = s.min_value.normalize()
+        max_value = s.max_value.normalize()
+        quantiles = s.quantiles()
+        if quantiles is not None:
+            quantiles = [ q.normalize() for q in quantiles ]
 
-    return render_to_response('search/criteria.html', {'criteria': criteria, 'min_value': min_value, 'max_value': max_value})
+    return render_to_response('search/criteria.html', {'criteria': criteria, 'min_value': min_value, 'max_value': max_value,
+                                                       'quantiles': quantiles})
 
 
 def getresult(request):
@@ -72,6 +107,11 @@ def getresult(request):
     It can work in two different ways:
     1) Form is valid => show results
     2) Form is not valid => show error message
+
+    The results are shown one page at a time, the "cursor" parameter is the
+    cursor of the page to show (no cursor is the first page). The results are
+    sorted by the stock property in "order_by" if it is selected, and the values
+    are the values as of the date in "asof" if it is given.
     """
 
     form = forms.SearchForm(request.POST)
@@ -79,12 +119,21 @@ def getresult(request):
 
     if form.is_valid():
 
-        headers, results = search.query(form.to_criteria(), form.cleaned_data['sector'], form.cleaned_data['exchange'], form.cleaned_data['show_result'])
+        try:
+            headers, results = search.query(form.to_criteria(), form.cleaned_data['sector'], form.cleaned_data['exchange'], form.cleaned_data['show_result'],
+                                            cursor=request.POST.get('cursor'), order=form.to_order(),
+                                            asof=form.cleaned_data.get('asof'))
+        except ValueError:
+            return render_to_response('search/result-error.html', {
+                'message': 'Please search again.',
+                'form': form
+            })
 
         # show result in response
         return render_to_response('search/result.html', {
             'headers': headers,
-            'results': results
+            'results': results,
+            'next_cursor': results.next_cursor
         })
 
     else:
@@ -93,3 +142,49 @@ def getresult(request):
             'message': 'Please enter details correctly.',
             'form': form
         })
+
+
+def exportresult(request, format):
+    """
+    Export result returns all the results of a query (not only one page) as a
+    CSV or NDJSON (format 'json') file. It takes the same parameters as getresult.
+
+    The response is a generator, so the rows are written while the results are
+    loaded (a batch at a time, see search.iter_results), and all the results are
+    never in memory at once.
+    """
+
+    form = forms.SearchForm(request.REQUEST)
+    form.find_minmax_criteria(request.REQUEST)
+
+    if not form.is_valid() or not export.FORMATS.has_key(format):
+        return HttpResponseBadRequest('Please enter details correctly.')
+
+    lines, mimetype, extension = export.FORMATS[format]
+    criterias = form.to_criteria()
+    headers = search.find_headers(criterias, form.cleaned_data['show_result'])
+    results = search.iter_results(criterias, headers, form.cleaned_data['sector'], form.cleaned_data['exchange'],
+                                  order=form.to_order(), asof=form.cleaned_data.get('asof'))
+
+    response = HttpResponse(lines(headers, results), mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=result.%s' % extension
+    return response
+
+
+def savescreen(request):
+    """
+    Save screen keeps the search of the form (the criterias, sector and exchange)
+    as the SavedScreen named in "screen_name", replacing a screen with the same
+    name. It takes the same parameters as getresult, and the saved screen can be
+    run at past dates by the backtest command.
+    """
+
+    form = forms.SearchForm(request.POST)
+    form.find_minmax_criteria(request.POST)
+
+    name = request.POST.get('screen_name', '').strip()
+    if not form.is_valid() or name == '':
+        return HttpResponseBadRequest('Please enter details correctly.')
+
+    screen = backtest.save_screen(name, form.to_criteria(), form.cleaned_data['sector'], form.cleaned_data['exchange'])
+    return HttpResponse('Saved the screen %s.' % screen.name, mimetype='text/plain')
@@ -0,0 +1,184 @@
+import datetime
+from django.conf import settings
+from django.db import connection, transaction
+from models import StockPropertyValue
+from stats import to_decimal
+import snapshot, timeseries
+
+"""
+The writer module saves the values found by an import in batches, instead of
+a get, a save and a look at the history for every single value (see
+Extractor.save_text).
+
+The values are kept by a ValueWriter until it has batch_size of them, then they
+are written in one transaction: the current values of the batch are found in one
+query, the new and changed values are written with one multi-row statement
+(INSERT ... ON DUPLICATE KEY UPDATE on MySQL, an UPDATE and an INSERT of many
+rows on the other databases), and the historical values are added at once
+(see timeseries.add_history).
+
+The history is never read: each value keeps its newest historical value
+(history_value), and a historical value is added when it is not the same as the
+value written, so the cost of a value does not grow with its history.
+
+The histograms and statistics are not updated for each value, the importers
+build them again after importing.
+"""
+
+# the number of values written in one transaction
+WRITE_BATCH = 500
+
+"""
+CURRENT_QUERY finds the current values of the companies in SYMBOLS and the
+stock properties in PROPERTIES.
+"""
+CURRENT_QUERY = """
+        select v.id, v.symbol_id, v.stock_property_id, v.value, v.history_value
+          from search_stockpropertyvalue v
+         where v.symbol_id in (SYMBOLS)
+           and v.stock_property_id in (PROPERTIES)
+"""
+
+UPSERT_QUERY = """
+        insert into search_stockpropertyvalue (symbol_id, stock_property_id, value, history_value)
+        values ROWS
+        on duplicate key update value = values(value), history_value = values(history_value)
+"""
+
+INSERT_QUERY = """
+        insert into search_stockpropertyvalue (symbol_id, stock_property_id, value, history_value)
+        values (%s, %s, %s, %s)
+"""
+
+UPDATE_QUERY = """
+        update search_stockpropertyvalue set value = %s, history_value = %s where id = %s
+"""
+
+def placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+def find_current(cursor, keys):
+    """
+    Returns {(company id, stock property id): (id, value, history value)} of the
+    current values of the keys.
+    """
+    symbols = list(set([ symbol_id for symbol_id, stock_property_id in keys ]))
+    properties = list(set([ stock_property_id for symbol_id, stock_property_id in keys ]))
+    sql = CURRENT_QUERY.replace('SYMBOLS', placeholders(symbols)).replace('PROPERTIES', placeholders(properties))
+    cursor.execute(sql, symbols + properties)
+
+    keys = set(keys)
+    current = {}
+    for id, symbol_id, stock_property_id, value, history_value in cursor.fetchall():
+        if (symbol_id, stock_property_id) in keys:
+            current[(symbol_id, stock_property_id)] = (id, to_decimal(value), to_decimal(history_value))
+    return current
+
+def write_values(values, date=None):
+    """
+    Write the values, a list of ((company id, stock property id), value), in
+    the current transaction. A historical value is added (at date, today if
+    None) when the value is not the newest historical value.
+
+    Returns the list of the written values (the new and changed values) as
+    (stock property value id, company id, stock property id, value).
+    """
+    if len(values) == 0:
+        return []
+    if date is None:
+        date = datetime.date.today()
+
+    cursor = connection.cursor()
+    current = find_current(cursor, [ key for key, value in values ])
+
+    # the new values, the changed values, and the values which are not the
+    # newest historical value (all get the value as their history value)
+    inserts = []
+    updates = []
+    history = []
+    for key, value in values:
+        if not current.has_key(key):
+            inserts.append((key, value))
+            history.append((key, value))
+        elif current[key][1] != value or current[key][2] != value:
+            updates.append((key, value))
+            if current[key][2] != value:
+                history.append((key, value))
+
+    if settings.DATABASE_ENGINE == 'mysql':
+        rows = inserts + updates
+        if len(rows) > 0:
+            params = []
+            for (symbol_id, stock_property_id), value in rows:
+                params.extend([symbol_id, stock_property_id, value, value])
+            cursor.execute(UPSERT_QUERY.replace('ROWS', ', '.join(['(%s, %s, %s, %s)'] * len(rows))), params)
+    else:
+        if len(updates) > 0:
+            cursor.executemany(UPDATE_QUERY, [ (value, value, current[key][0]) for key, value in updates ])
+        if len(inserts) > 0:
+            cursor.executemany(INSERT_QUERY, [ (key[0], key[1], value, value) for key, value in inserts ])
+
+    # the new and changed values (not only a new history value)
+    written = inserts + [ (key, value) for key, value in updates if current[key][1] != value ]
+
+    # the ids of the new values
+    if len(inserts) > 0:
+        current.update(find_current(cursor, [ key for key, value in inserts ]))
+
+    timeseries.add_history([ (current[key][0], value, date) for key, value in history ])
+
+    transaction.set_dirty()
+
+    return [ (current[key][0], key[0], key[1], value) for key, value in written ]
+
+write_batch = transaction.commit_on_success(write_values)
+
+class ValueWriter(object):
+    """
+    Value writer keeps the values added to it, and writes them in one
+    transaction when it has batch_size values (see write_values). flush must be
+    called when all the values are added.
+    """
+
+    batch_size = WRITE_BATCH
+
+    def __init__(self, batch_size=WRITE_BATCH):
+        self.batch_size = batch_size
+        self.values = {}
+        self.order = []
+        self.written = 0
+        self.batches = 0
+
+    def add(self, company, stock_property, value):
+        """
+        Add the value of the stock property for the company, a value added again
+        before it is written replaces the first. Returns the (unsaved)
+        StockPropertyValue.
+        """
+        key = (company.id, stock_property.id)
+        if not self.values.has_key(key):
+            self.order.append(key)
+        self.values[key] = value
+        if len(self.order) >= self.batch_size:
+            self.flush()
+        return StockPropertyValue(symbol=company, stock_property=stock_property, value=value)
+
+    def flush(self):
+        """
+        Write the values added since the last flush.
+        """
+        if len(self.order) == 0:
+            return
+        values = [ (key, self.values[key]) for key in self.order ]
+        self.values = {}
+        self.order = []
+
+        written = write_batch(values)
+        self.written += len(written)
+        self.batches += 1
+
+        # keep the in-memory snapshot (if loaded) up to date
+        for id, symbol_id, stock_property_id, value in written:
+            snapshot.value_saved(StockPropertyValue(id=id, symbol_id=symbol_id,
+                                                    stock_property_id=stock_property_id,
+                                                    value=value))
@@ -98,3 +98,53 @@ if DEBUG:
 	local_ip = socket.gethostbyname(socket.gethostname())
 	if local_ip.startswith('172.'):
 		USE_PROXY = True
+
+# search in the in-memory snapshot of the values, instead of the database
+# (see search/snapshot.py). When False the search is done with SQL.
+USE_MEMORY_SEARCH = False
+
+# how the search finds the matching companies when USE_MEMORY_SEARCH is False:
+# 'union' (one query for all criterias) or 'intersect' (one query per criteria).
+SEARCH_STRATEGY = 'union'
+
+# the number of search results kept in the cache (0 disables the cache)
+SEARCH_CACHE_SIZE = 100
+
+# the number of rendered distribution graphs kept in the cache (0 disables the cache)
+GRAPH_CACHE_SIZE = 100
+
+# the number of seconds a browser may keep a distribution graph
+GRAPH_MAX_AGE = 3600
+
+# the number of downloaded pages the importers keep in memory, and for how many
+# seconds. Pages that do not fit in memory are written to PAGE_CACHE_DIR (if set).
+PAGE_CACHE_SIZE = 100
+PAGE_CACHE_TTL = 3600
+PAGE_CACHE_DIR = None
+
+# the number of pages importall downloads at the same time, at most
+# IMPORT_HOST_LIMIT from one host, with IMPORT_HOST_DELAY seconds between them.
+# The stock properties usually all come from one host (www.reuters.com), so the
+# host limits are the real limits: IMPORT_HOST_LIMIT pages at a time and, if
+# IMPORT_HOST_DELAY is set, at most 1 / IMPORT_HOST_DELAY pages a second (no
+# matter how many IMPORT_WORKERS). The delay is off, set it to be polite to a
+# host which throttles.
+IMPORT_WORKERS = 4
+IMPORT_HOST_LIMIT = 2
+IMPORT_HOST_DELAY = 0.0
+
+# how importall downloads the pages: 'threads' (IMPORT_WORKERS threads) or
+# 'async' (one thread with keep-alive connections, see search/asyncfetcher.py)
+IMPORT_ENGINE = 'threads'
+
+# the number of processes importall parses the pages with, to use more than one
+# core (0 parses the pages in the download threads)
+IMPORT_PARSE_PROCESSES = 0
+
+# the number of values importall writes to the database in one transaction
+IMPORT_WRITE_BATCH = 500
+
+# where the historical values are kept: 'table' (a StockPropertyValueHistory row
+# per value) or 'series' (packed arrays per year, see search/timeseries.py).
+# migratehistory copies the table to the series.
+HISTORY_BACKEND = 'table'
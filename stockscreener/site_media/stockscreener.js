@@ -24,3 +24,40 @@ function search(resultId, aForm) {
     });
     return false;
 }
+
+function nextPage(resultId, formId, cursor) {
+    // same search as the form, but the page after cursor
+    var aForm = $(formId);
+    var parameters = aForm.serialize(true);
+    parameters.cursor = cursor;
+    new Ajax.Updater(resultId, aForm.action, {
+        parameters: parameters
+    });
+    return false;
+}
+
+function exportResult(formId, format) {
+    // download all the results of the same search as the form
+    var aForm = $(formId);
+    window.location = '/search/export/' + format + '/?' + aForm.serialize();
+    return false;
+}
+
+function saveScreen(formId) {
+    // save the search of the form as a screen (for the backtest command)
+    var name = prompt('Save the screen as:');
+    if (name) {
+        var parameters = $(formId).serialize(true);
+        parameters.screen_name = name;
+        new Ajax.Request('/search/savescreen/', {
+            parameters: parameters,
+            onSuccess: function(transport) {
+                alert(transport.responseText);
+            },
+            onFailure: function(transport) {
+                alert('Error! ' + transport.responseText);
+            }
+        });
+    }
+    return false;
+}
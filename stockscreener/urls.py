@@ -19,6 +19,8 @@ urlpatterns = patterns('',
                        (r'^search/$', 'stockscreener.search.views.index'),
                        (r'^search/criteria/(?P<stock_property_id>\d+)/$', 'stockscreener.search.views.addcriteria'),
                        (r'^search/result/$', 'stockscreener.search.views.getresult'),
+                       (r'^search/export/(?P<format>csv|json)/$', 'stockscreener.search.views.exportresult'),
+                       (r'^search/savescreen/$', 'stockscreener.search.views.savescreen'),
                        # Example:
                        # (r'^stockscreener/', include('stockscreener.foo.urls')),
 )